@@ -6,4 +6,5 @@ __version__ = '0.1'
 
 from ._opcodes import OPCODES, I
 from .components import *
+from .wat import *
 from .util import *
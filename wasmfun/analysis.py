@@ -0,0 +1,431 @@
+"""
+Analysis of the control flow of function definitions.
+
+A ControlFlowGraph splits the (structured) instructions of a function
+definition into basic blocks, and can compute the dominators, the loops
+and the liveness of the locals. Sets of locals are represented as ints, in
+which bit i is set for local i, so that the analysis remains fast for
+functions with many locals and instructions.
+"""
+
+from .components import _iter_flat
+
+
+__all__ = ['BasicBlock', 'Loop', 'ControlFlowGraph']
+
+
+class BasicBlock:
+    """ A sequence of instructions that is only entered at the start, and
+    only left at the end. The control instructions (block, loop, if, else,
+    end and the branches) are part of the blocks too, so that joining the
+    instructions of all blocks gives the original instructions.
+    """
+
+    __slots__ = ['index', 'instructions', 'successors', 'predecessors', 'idom', 'loop',
+                 'live_in', 'live_out', '_order', '_pre', '_post']
+
+    def __init__(self, index):
+        self.index = index
+        self.instructions = []
+        self.successors = []
+        self.predecessors = []
+        self.idom = None  # the immediate dominator
+        self.loop = None  # the innermost loop that the block is in
+        self.live_in = 0  # the locals that are live at the start
+        self.live_out = 0  # the locals that are live at the end
+        self._order = None  # index in reverse postorder, None if not reachable
+        self._pre = self._post = 0  # numbering of the dominator tree
+
+    def __repr__(self):
+        return '<BasicBlock %i with %i instructions>' % (self.index, len(self.instructions))
+
+    def is_reachable(self):
+        """ Get whether the block can be reached from the entry block (only
+        known after the dominators have been computed).
+        """
+        return self._order is not None
+
+    def get_live_after(self):
+        """ Get a list with, for each instruction, the locals that are live
+        right after that instruction (requires the liveness to be computed).
+        """
+        live = self.live_out
+        result = [0] * len(self.instructions)
+        for i in range(len(self.instructions) - 1, -1, -1):
+            result[i] = live
+            instruction = self.instructions[i]
+            type = instruction.type
+            if type == 'get_local':
+                live |= 1 << instruction.args[0]
+            elif type in ('set_local', 'tee_local'):
+                live &= ~(1 << instruction.args[0])
+        return result
+
+
+class Loop:
+    """ A natural loop: a header block that dominates all blocks of the loop,
+    and that the loop branches back to.
+    """
+
+    __slots__ = ['header', 'blocks', 'parent', 'children', 'depth']
+
+    def __init__(self, header):
+        self.header = header
+        self.blocks = [header]  # all blocks, including those of inner loops
+        self.parent = None  # the enclosing loop
+        self.children = []  # the loops directly inside this loop
+        self.depth = 1
+
+    def __repr__(self):
+        return '<Loop at block %i with %i blocks>' % (self.header.index, len(self.blocks))
+
+
+class _Frame:
+    # A block, loop or if (or the function) while building the graph
+
+    __slots__ = ['type', 'target', 'sources', 'branch_block']
+
+    def __init__(self, type, target):
+        self.type = type
+        self.target = target  # the block that branches go to, if known
+        self.sources = []  # the blocks that go to the end (if target is None)
+        self.branch_block = None  # the block of an if, until the else
+
+
+class ControlFlowGraph:
+    """ The control flow graph of a function definition. The blocks are in
+    the order of the instructions, the first being the entry block. The
+    exit block (where the function returns) is separate and has no
+    instructions. Nested instructions are flattened.
+
+    The dominators, loops and liveness are computed on demand, using
+    compute_dominators(), find_loops() and compute_liveness(). Blocks that
+    cannot be reached are part of the graph, but have no dominators and
+    are not part of any loop.
+
+    Raises ValueError if the blocks of the function are not properly
+    nested, or if a branch refers to a block that does not exist.
+    """
+
+    __slots__ = ['num_locals', 'blocks', 'entry', 'exit', 'loops', '_reachable']
+
+    def __init__(self, functiondef, num_params=0):
+        self.num_locals = num_params + len(functiondef.locals)
+        self.blocks = []
+        self.exit = BasicBlock(-1)
+        self.entry = self._new_block()
+        self.loops = None
+        self._reachable = None
+        self._build(_iter_flat(functiondef.instructions))
+        self.exit.index = len(self.blocks)
+
+    def __repr__(self):
+        return '<ControlFlowGraph with %i blocks>' % len(self.blocks)
+
+    def _new_block(self):
+        block = BasicBlock(len(self.blocks))
+        self.blocks.append(block)
+        return block
+
+    def _add_edge(self, source, target):
+        if target not in source.successors:
+            source.successors.append(target)
+            target.predecessors.append(source)
+
+    def _split(self, current, falls):
+        # Start a block after the current block. An empty block is re-used.
+        if not current.instructions and current is not self.entry:
+            return current
+        block = self._new_block()
+        if falls:
+            self._add_edge(current, block)
+        return block
+
+    def _branch(self, current, frames, depth):
+        if depth >= len(frames):
+            raise ValueError('Branch to depth %i in only %i blocks.' % (depth, len(frames) - 1))
+        frame = frames[-1 - depth]
+        if frame.target is None:
+            frame.sources.append(current)
+        else:
+            self._add_edge(current, frame.target)
+
+    def _build(self, instructions):
+        current = self.entry
+        frames = [_Frame('function', self.exit)]
+        for instruction in instructions:
+            type = instruction.type
+            if type == 'block':
+                current.instructions.append(instruction)
+                frames.append(_Frame(type, None))
+            elif type == 'loop':
+                current = self._split(current, True)
+                current.instructions.append(instruction)
+                frames.append(_Frame(type, current))
+            elif type == 'if':
+                current.instructions.append(instruction)
+                frame = _Frame(type, None)
+                frame.branch_block = current
+                frames.append(frame)
+                current = self._split(current, True)
+            elif type == 'else':
+                frame = frames[-1]
+                if frame.type != 'if' or frame.branch_block is None:
+                    raise ValueError('Else without if.')
+                current.instructions.append(instruction)
+                frame.sources.append(current)
+                current = self._new_block()
+                self._add_edge(frame.branch_block, current)
+                frame.branch_block = None
+            elif type == 'end':
+                if len(frames) == 1:
+                    raise ValueError('End without block.')
+                frame = frames.pop()
+                if frame.type != 'loop':
+                    current = self._split(current, True)
+                    for source in frame.sources:
+                        self._add_edge(source, current)
+                    if frame.branch_block is not None:
+                        self._add_edge(frame.branch_block, current)  # if without else
+                current.instructions.append(instruction)
+            elif type in ('br', 'br_if'):
+                current.instructions.append(instruction)
+                self._branch(current, frames, instruction.args[0])
+                current = self._split(current, type == 'br_if')
+            elif type == 'br_table':
+                current.instructions.append(instruction)
+                for depth in list(instruction.args[0]) + [instruction.args[1]]:
+                    self._branch(current, frames, depth)
+                current = self._split(current, False)
+            elif type in ('return', 'unreachable'):
+                current.instructions.append(instruction)
+                if type == 'return':
+                    self._add_edge(current, self.exit)
+                current = self._split(current, False)
+            else:
+                current.instructions.append(instruction)
+        if len(frames) != 1:
+            raise ValueError('Missing end for %i blocks.' % (len(frames) - 1))
+        if not current.instructions and not current.predecessors and current is not self.entry:
+            self.blocks.pop()  # empty block after the last branch
+        else:
+            self._add_edge(current, self.exit)
+
+    def to_instructions(self):
+        """ Get the (structured) instructions of the function from the
+        blocks. The instructions of the blocks can be modified, but the
+        control instructions must stay in place, so that the structure
+        (and thereby the graph) remains the same.
+        """
+        return [instruction for block in self.blocks for instruction in block.instructions]
+
+    def _search(self):
+        # Depth-first search from the entry block. Returns the blocks that
+        # can be reached in preorder, the parent of each block in the search
+        # tree (as index in preorder), and the blocks in postorder.
+        preorder, parents, postorder = [self.entry], [-1], []
+        numbers = {self.entry: 0}
+        stack = [(self.entry, iter(self.entry.successors))]
+        while stack:
+            block, successors = stack[-1]
+            for successor in successors:
+                if successor not in numbers:
+                    numbers[successor] = len(preorder)
+                    preorder.append(successor)
+                    parents.append(numbers[block])
+                    stack.append((successor, iter(successor.successors)))
+                    break
+            else:
+                stack.pop()
+                postorder.append(block)
+        return preorder, parents, postorder
+
+    def get_reverse_postorder(self):
+        """ Get the blocks that can be reached from the entry block (including
+        the exit block if it is reached), in reverse postorder.
+        """
+        postorder = self._search()[2]
+        postorder.reverse()
+        return postorder
+
+    def compute_dominators(self):
+        """ Compute the immediate dominator of each block that can be reached,
+        using the algorithm of Lengauer and Tarjan (with path compression),
+        which takes O(n log n) time, also for blocks with many predecessors.
+        Sets the idom attribute of the blocks (None for the entry block).
+        """
+        for block in self.blocks + [self.exit]:
+            block.idom = block._order = None
+        preorder, parents, postorder = self._search()
+        order = postorder[::-1]
+        for i, block in enumerate(order):
+            block._order = i
+        # Blocks are represented by their index in preorder
+        n = len(preorder)
+        numbers = {block: i for i, block in enumerate(preorder)}
+        semi = list(range(n))  # the semidominators
+        idoms = [0] * n
+        same_idoms = [-1] * n  # blocks that have the same idom (set when known)
+        ancestors = [-1] * n  # the forest of blocks that have been processed
+        best = list(range(n))  # the block with the lowest semi on the path to an ancestor
+        buckets = [[] for i in range(n)]
+
+        def get_lowest_ancestor(v):
+            # Get the block with the lowest semidominator on the path from v
+            # to the root of its tree, and compress the path.
+            path = []
+            while ancestors[ancestors[v]] != -1:
+                path.append(v)
+                v = ancestors[v]
+            for u in reversed(path):
+                a = ancestors[u]
+                ancestors[u] = ancestors[a]
+                if semi[best[a]] < semi[best[u]]:
+                    best[u] = best[a]
+            return best[path[0]] if path else best[v]
+
+        for w in range(n - 1, 0, -1):
+            parent = parents[w]
+            s = parent
+            for block in preorder[w].predecessors:
+                v = numbers.get(block)
+                if v is None:
+                    continue  # not reachable
+                elif v > w:
+                    v = semi[get_lowest_ancestor(v)]
+                if v < s:
+                    s = v
+            semi[w] = s
+            buckets[s].append(w)
+            ancestors[w] = parent
+            for v in buckets[parent]:
+                y = get_lowest_ancestor(v)
+                if semi[y] == semi[v]:
+                    idoms[v] = parent
+                else:
+                    same_idoms[v] = y
+            buckets[parent] = []
+        for w in range(1, n):
+            if same_idoms[w] != -1:
+                idoms[w] = idoms[same_idoms[w]]
+        # Number the dominator tree, so that dominance can be checked quickly
+        children = [[] for i in range(n)]
+        for w in range(1, n):
+            preorder[w].idom = preorder[idoms[w]]
+            children[idoms[w]].append(w)
+        count = 0
+        stack = [(0, iter(children[0]))]
+        preorder[0]._pre = 0
+        while stack:
+            w, iterator = stack[-1]
+            for v in iterator:
+                count += 1
+                preorder[v]._pre = count
+                stack.append((v, iter(children[v])))
+                break
+            else:
+                stack.pop()
+                preorder[w]._post = count
+        self._reachable = order
+
+    def dominates(self, a, b):
+        """ Get whether block a dominates block b (each block dominates
+        itself). Requires the dominators to be computed.
+        """
+        if a._order is None or b._order is None:
+            return False
+        return a._pre <= b._pre and b._post <= a._post
+
+    def find_loops(self):
+        """ Find the (natural) loops and how they are nested. Sets the loop
+        attribute of the blocks and returns the loops, outer loops before the
+        loops inside them. Computes the dominators if needed.
+        """
+        if self._reachable is None:
+            self.compute_dominators()
+        for block in self.blocks:
+            block.loop = None
+        loops = []
+        # Inner loops are found first, because their headers come later in
+        # reverse postorder. A block that is already in a loop stands for
+        # the outermost loop that was found for it so far.
+        for header in reversed(self._reachable):
+            latches = [p for p in header.predecessors if self.dominates(header, p)]
+            if not latches:
+                continue
+            loop = Loop(header)
+            header.loop = loop
+            loops.append(loop)
+            todo = [p for p in latches if p is not header]
+            while todo:
+                block = todo.pop()
+                inner = block.loop
+                if inner is None:
+                    block.loop = loop
+                    loop.blocks.append(block)
+                else:
+                    while inner.parent is not None:
+                        inner = inner.parent
+                    if inner is loop:
+                        continue
+                    inner.parent = loop
+                    loop.children.append(inner)
+                    block = inner.header
+                todo.extend(p for p in block.predecessors if p._order is not None)
+        # Add the blocks of inner loops to their outer loops
+        for loop in loops:
+            if loop.parent is not None:
+                loop.parent.blocks.extend(loop.blocks)
+        loops.reverse()
+        for loop in loops:
+            loop.depth = 1 if loop.parent is None else loop.parent.depth + 1
+        self.loops = loops
+        return loops
+
+    def compute_liveness(self):
+        """ Compute which locals are live (i.e. may be read before they are
+        set) at the start and end of each block. Sets the live_in and live_out
+        attributes of the blocks. Locals that are live at the start of the
+        entry block are parameters, or locals that are read while still zero.
+        """
+        gens, kills = [], []
+        for block in self.blocks:
+            gen = kill = 0
+            for instruction in reversed(block.instructions):
+                type = instruction.type
+                if type == 'get_local':
+                    gen |= 1 << instruction.args[0]
+                elif type in ('set_local', 'tee_local'):
+                    bit = 1 << instruction.args[0]
+                    gen &= ~bit
+                    kill |= bit
+            gens.append(gen)
+            kills.append(kill)
+            block.live_in = gen
+            block.live_out = 0
+        self.exit.live_in = self.exit.live_out = 0
+        # Process the blocks backwards, and again when a successor changes
+        todo = list(self.blocks)
+        queued = [True] * len(self.blocks)
+        while todo:
+            block = todo.pop()
+            queued[block.index] = False
+            live_out = 0
+            for successor in block.successors:
+                live_out |= successor.live_in
+            block.live_out = live_out
+            live_in = gens[block.index] | (live_out & ~kills[block.index])
+            if live_in != block.live_in:
+                block.live_in = live_in
+                for predecessor in block.predecessors:
+                    if not queued[predecessor.index]:
+                        queued[predecessor.index] = True
+                        todo.append(predecessor)
+
+
+def _iter_bits(mask):
+    # Iterate over the indices of the bits that are set
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
@@ -2,10 +2,18 @@
 The field classes to represent a WASM program.
 """
 
-from io import BytesIO
-from struct import pack as spack
+import io
+import sys
+import itertools
+from array import array
+import mmap
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import blake2b
+from math import copysign, inf
+from struct import pack as spack, pack_into, unpack_from
 
-from . import OPCODES
+from ._opcodes import OPCODE_TABLE, IMMEDIATE_ARG_COUNTS, STACK_EFFECTS, WAT_NAMES
 
 
 LANG_TYPES = {
@@ -18,6 +26,12 @@ LANG_TYPES = {
     'emptyblock': b'\x40',  # pseudo type for representing an empty block_type
     }
 
+LANG_TYPE_NAMES = {v[0]: k for k, v in LANG_TYPES.items()}
+
+# Versions of the function index spaces of modules. These are unique over all
+# modules, because a function definition can be linked in multiple modules.
+_INDEX_VERSIONS = itertools.count(1)
+
 
 def packf64(x):
     return spack('<d', x)
@@ -62,20 +76,15 @@ def packvu1(x):
 
 
 def signed_leb128_encode(value):
-    bb = []
-    if value < 0:
-        unsignedRefValue = (1 - value) * 2
-    else:
-        unsignedRefValue = value * 2
+    bb = []  # ints, really
     while True:
         byte = value & 0x7F
         value >>= 7
-        unsignedRefValue >>= 7
-        if unsignedRefValue != 0:
-            byte = byte | 0x80
-        bb.append(byte)
-        if unsignedRefValue == 0:
+        # Stop when the remaining value is just sign extension of this byte
+        if (value == 0 and not byte & 0x40) or (value == -1 and byte & 0x40):
+            bb.append(byte)
             break
+        bb.append(byte | 0x80)
     return bytes(bb)
 
 
@@ -92,6 +101,417 @@ def unsigned_leb128_encode(value):
     return bytes(bb)
 
 
+# Size computations and in-place writers, used by the encoder to first
+# determine the size of each component, and then write all components
+# into a single preallocated bytearray.
+
+def uleb_size(value):
+    """ Get the number of bytes needed to encode an unsigned LEB128 value.
+    """
+    return (value.bit_length() + 6) // 7 or 1
+
+
+def sleb_size(value):
+    """ Get the number of bytes needed to encode a signed LEB128 value.
+    """
+    if value < 0:
+        value = ~value
+    return (value.bit_length() + 7) // 7
+
+
+def write_uleb(bb, pos, value):
+    """ Write an unsigned LEB128 value into bytearray bb at the given
+    position. Returns the new position.
+    """
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            bb[pos] = byte | 0x80
+            pos += 1
+        else:
+            bb[pos] = byte
+            return pos + 1
+
+
+def write_sleb(bb, pos, value):
+    """ Write a signed LEB128 value into bytearray bb at the given
+    position. Returns the new position.
+    """
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if (value == 0 and not byte & 0x40) or (value == -1 and byte & 0x40):
+            bb[pos] = byte
+            return pos + 1
+        bb[pos] = byte | 0x80
+        pos += 1
+
+
+def write_bytes(bb, pos, x):
+    """ Write bytes (or any buffer) into bytearray bb at the given position.
+    Returns the new position.
+    """
+    end = pos + len(x)
+    bb[pos:end] = x
+    return end
+
+
+def read_uleb(bb, pos):
+    """ Read an unsigned LEB128 value from bb at the given position.
+    Returns (value, new_position).
+    """
+    result = shift = 0
+    while True:
+        byte = bb[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return result, pos
+
+
+def read_sleb(bb, pos):
+    """ Read a signed LEB128 value from bb at the given position.
+    Returns (value, new_position).
+    """
+    result = shift = 0
+    while True:
+        byte = bb[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            if byte & 0x40:
+                result -= 1 << shift
+            return result, pos
+
+
+def _read_str(bb, pos):
+    # Read a length-prefixed utf-8 string. Returns (string, new_position).
+    size, pos = read_uleb(bb, pos)
+    return bytes(bb[pos:pos + size]).decode('utf-8'), pos + size
+
+
+def _read_types(bb, pos):
+    # Read a count-prefixed list of value types. Returns (list, new_position).
+    count, pos = read_uleb(bb, pos)
+    return [LANG_TYPE_NAMES[bb[i]] for i in range(pos, pos + count)], pos + count
+
+
+# Encoders for the immediates of instructions. Each kind of immediate has
+# a function to get its size and a function to write it. Both take the
+# args of the instruction and the index of the (first) arg to encode.
+
+def _size_varuint32(args, i):
+    return uleb_size(args[i])
+
+
+def _write_varuint32(bb, pos, args, i):
+    return write_uleb(bb, pos, args[i])
+
+
+def _size_varint32(args, i):
+    size = sleb_size(args[i])
+    assert size <= 5
+    return size
+
+
+def _size_varint64(args, i):
+    size = sleb_size(args[i])
+    assert size <= 10
+    return size
+
+
+def _write_varint(bb, pos, args, i):
+    return write_sleb(bb, pos, args[i])
+
+
+def _size_f32(args, i):
+    return 4
+
+
+def _write_f32(bb, pos, args, i):
+    pack_into('<f', bb, pos, args[i])
+    return pos + 4
+
+
+def _size_f64(args, i):
+    return 8
+
+
+def _write_f64(bb, pos, args, i):
+    pack_into('<d', bb, pos, args[i])
+    return pos + 8
+
+
+def _size_block_type(args, i):
+    return 1
+
+
+def _write_block_type(bb, pos, args, i):
+    bb[pos] = LANG_TYPES[args[i]][0]
+    return pos + 1
+
+
+def _size_memarg(args, i):
+    return uleb_size(args[i]) + uleb_size(args[i + 1])
+
+
+def _write_memarg(bb, pos, args, i):
+    pos = write_uleb(bb, pos, args[i])  # flags (alignment)
+    return write_uleb(bb, pos, args[i + 1])  # offset
+
+
+def _size_br_table(args, i):
+    targets = args[i]
+    return (uleb_size(len(targets)) + sum(uleb_size(t) for t in targets) +
+            uleb_size(args[i + 1]))
+
+
+def _write_br_table(bb, pos, args, i):
+    targets = args[i]
+    pos = write_uleb(bb, pos, len(targets))
+    for target in targets:
+        pos = write_uleb(bb, pos, target)
+    return write_uleb(bb, pos, args[i + 1])  # default target
+
+
+def _size_reserved(args, i):
+    return 1
+
+
+def _write_reserved(bb, pos, args, i):
+    bb[pos] = 0
+    return pos + 1
+
+
+_IMMEDIATE_ENCODERS = {
+    'varuint32': (_size_varuint32, _write_varuint32),
+    'varint32': (_size_varint32, _write_varint),
+    'varint64': (_size_varint64, _write_varint),
+    'f32': (_size_f32, _write_f32),
+    'f64': (_size_f64, _write_f64),
+    'block_type': (_size_block_type, _write_block_type),
+    'memarg': (_size_memarg, _write_memarg),
+    'br_table': (_size_br_table, _write_br_table),
+    'reserved': (_size_reserved, _write_reserved),
+    }
+
+
+# Decoders for the immediates. Each takes the bytes and position, appends
+# the decoded arg(s) to the given list, and returns the new position.
+
+def _read_varuint32(bb, pos, args):
+    value, pos = read_uleb(bb, pos)
+    args.append(value)
+    return pos
+
+
+def _read_varint(bb, pos, args):
+    value, pos = read_sleb(bb, pos)
+    args.append(value)
+    return pos
+
+
+def _read_f32(bb, pos, args):
+    args.append(unpack_from('<f', bb, pos)[0])
+    return pos + 4
+
+
+def _read_f64(bb, pos, args):
+    args.append(unpack_from('<d', bb, pos)[0])
+    return pos + 8
+
+
+def _read_block_type(bb, pos, args):
+    args.append(LANG_TYPE_NAMES[bb[pos]])
+    return pos + 1
+
+
+def _read_memarg(bb, pos, args):
+    pos = _read_varuint32(bb, pos, args)  # flags (alignment)
+    return _read_varuint32(bb, pos, args)  # offset
+
+
+def _read_br_table(bb, pos, args):
+    count, pos = read_uleb(bb, pos)
+    targets = []
+    for i in range(count):
+        pos = _read_varuint32(bb, pos, targets)
+    args.append(targets)
+    return _read_varuint32(bb, pos, args)  # default target
+
+
+def _read_reserved(bb, pos, args):
+    return pos + 1
+
+
+_IMMEDIATE_DECODERS = {
+    'varuint32': _read_varuint32,
+    'varint32': _read_varint,
+    'varint64': _read_varint,
+    'f32': _read_f32,
+    'f64': _read_f64,
+    'block_type': _read_block_type,
+    'memarg': _read_memarg,
+    'br_table': _read_br_table,
+    'reserved': _read_reserved,
+    }
+
+
+def _make_opcode_encoders():
+    # Map opcode name to (opcode, nargs, encoders), where encoders is a tuple
+    # of (arg_index, size_func, write_func) tuples.
+    opcode_encoders = {}
+    for name, opcode, immediates in OPCODE_TABLE:
+        encoders = []
+        nargs = 0
+        for kind in immediates:
+            encoders.append((nargs, ) + _IMMEDIATE_ENCODERS[kind])
+            nargs += IMMEDIATE_ARG_COUNTS[kind]
+        opcode_encoders[name] = opcode, nargs, tuple(encoders)
+    return opcode_encoders
+
+_OPCODE_ENCODERS = _make_opcode_encoders()
+
+# Instructions that refer to a local by index
+_LOCAL_INSTRUCTIONS = frozenset(['get_local', 'set_local', 'tee_local'])
+
+# Map opcode byte to (name, decoders)
+_OPCODE_DECODERS = {opcode: (name, tuple(_IMMEDIATE_DECODERS[kind] for kind in immediates))
+                    for name, opcode, immediates in OPCODE_TABLE}
+
+
+def read_instruction(bb, pos):
+    """ Read the instruction from bb at the given position. Returns
+    (type, args, new_position).
+    """
+    try:
+        type, decoders = _OPCODE_DECODERS[bb[pos]]
+    except KeyError:
+        raise TypeError('Unknown opcode 0x%02x at %i' % (bb[pos], pos)) from None
+    pos += 1
+    args = []
+    for read in decoders:
+        pos = read(bb, pos, args)
+    return type, args, pos
+
+
+def _read_section(bb, pos, lazy=False):
+    # Read a section from bb at the given position. Returns (section, new_position).
+    # Sections that cannot be represented by their class become a RawSection.
+    start = pos
+    id = bb[pos]
+    size, pos = read_uleb(bb, pos + 1)
+    end = pos + size
+    if end > len(bb):
+        raise ValueError('Section with id %i extends beyond the end of the data.' % id)
+    section = None
+    cls = _SECTION_CLASSES.get(id)
+    if cls is not None:
+        try:
+            section, pos2 = cls._read_payload(bb, pos, end, lazy)
+        except (KeyError, TypeError):
+            section = None  # unknown value type or opcode
+        if section is not None and pos2 != end:
+            raise ValueError('Section with id %i has %i bytes, but %i are used.' %
+                             (id, size, pos2 - pos))
+    if section is None:
+        section = RawSection(id, bb[pos:end])
+    section._raw = bb[start:end]
+    return section, end
+
+
+def _read_function_body(bb, pos):
+    # Read a function body (prefixed with its size). Returns (locals, instructions).
+    start = pos
+    size, pos = read_uleb(bb, pos)
+    end = pos + size
+    count, pos = read_uleb(bb, pos)
+    locals = []
+    for i in range(count):
+        n, pos = read_uleb(bb, pos)
+        locals.extend([LANG_TYPE_NAMES[bb[pos]]] * n)
+        pos += 1
+    instructions = []
+    while pos < end - 1:
+        type, args, pos = read_instruction(bb, pos)
+        instructions.append(Instruction(type, *args))
+    if pos != end - 1 or bb[pos] != 0x0b:
+        raise ValueError('Function body at %i does not end with "end".' % start)
+    return locals, instructions
+
+
+# Dirty tracking: components cache their binary representation, and
+# drop the cache when they are modified.
+
+def _make_tracking_method(cls, name):
+    method = getattr(cls, name)
+    def tracking_method(self, *args, **kwargs):
+        self._callback()
+        return method(self, *args, **kwargs)
+    tracking_method.__name__ = name
+    return tracking_method
+
+
+class _TrackedList(list):
+    """ A list that calls a callback when it is modified.
+    """
+    
+    __slots__ = ['_callback']
+    
+    def __init__(self, items, callback):
+        list.__init__(self, items)
+        self._callback = callback
+    
+    def __reduce__(self):
+        return list, (list(self), )  # the callback is not pickled
+
+for _name in ('__setitem__', '__delitem__', '__iadd__', '__imul__', 'append', 'extend',
+              'insert', 'pop', 'remove', 'clear', 'sort', 'reverse'):
+    setattr(_TrackedList, _name, _make_tracking_method(list, _name))
+
+
+class _TrackedDict(dict):
+    """ A dict that calls a callback when it is modified.
+    """
+    
+    __slots__ = ['_callback']
+    
+    def __init__(self, items, callback):
+        dict.__init__(self, items)
+        self._callback = callback
+    
+    def __reduce__(self):
+        return dict, (dict(self), )  # the callback is not pickled
+
+for _name in ('__setitem__', '__delitem__', '__ior__', 'pop', 'popitem', 'clear',
+              'setdefault', 'update'):
+    if hasattr(dict, _name):  # __ior__ is new in Python 3.9
+        setattr(_TrackedDict, _name, _make_tracking_method(dict, _name))
+
+
+class _Tracked:
+    """ Mixin for components that invalidate themselves when a public
+    attribute is set. Lists and dicts are wrapped so that modifying them
+    invalidates the component too.
+    """
+    
+    __slots__ = []
+    
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            if type(value) is list:
+                value = _TrackedList(value, self.invalidate)
+            elif type(value) is dict:
+                value = _TrackedDict(value, self.invalidate)
+            object.__setattr__(self, name, value)
+            self.invalidate()
+
+
 class WASMComponent:
     """Base class for representing components of a WASM module, from the module
     to sections and instructions. These components can be shown as text or
@@ -102,7 +522,13 @@ class WASMComponent:
     * `show()` - Print a textual representation of the component.
     * `to_file(f)` - Write the binary representation of this component to a file.
     * `to_text()` - Return a textual representation of this component.
+    * `write_text(f)` - Write a textual representation of this component to a file.
+    
+    * `invalidate()` - Clear cached binary representations.
     
+    Binary encoding happens in two passes: `_get_size()` computes the
+    number of bytes (bottom-up), after which `_write_into()` writes the
+    component into a preallocated bytearray. Subclasses implement these two.
     """
     
     __slots__ = []
@@ -140,39 +566,106 @@ class WASMComponent:
     def to_bytes(self):
         """ Get the bytes that represent the binary WASM for this component.
         """
-        f = BytesIO()
-        self.to_file(f)
-        return f.getvalue()
+        size = self._get_size()
+        bb = bytearray(size)
+        pos = self._write_into(bb, 0)
+        assert pos == size, 'Size mismatch in encoding %s' % self.__class__.__name__
+        return bytes(bb)
     
     def show(self):
         """ Print a textual representation of the component.
         """
-        print(self.to_text())
+        self.write_text(sys.stdout)
     
     def to_file(self, f):
         """ Write the binary representation of this component to a file.
-        Implemented in the subclasses.
         """
-        raise NotImplementedError()
+        f.write(self.to_bytes())
     
     def to_text(self):
         """ Return a textual representation of this component.
+        Implemented in the subclasses (or via `_write_text()`).
+        """
+        f = io.StringIO()
+        self._write_text(f, '')
+        return f.getvalue().rstrip('\n')
+    
+    def write_text(self, f, wat=False):
+        """ Write a textual representation of this component to a file (or
+        file-like object). The text is written line by line, in a single
+        pass over the components. If wat is True, the standard WebAssembly
+        text format is written (supported for modules only).
+        """
+        if wat:
+            self._write_wat(f)
+        else:
+            self._write_text(f, '')
+    
+    def _write_text(self, f, indent):
+        # Write the text, indented. Components that contain other components
+        # implement this (instead of to_text()) to write these one by one.
+        for line in self.to_text().splitlines():
+            f.write(indent + line + '\n')
+    
+    def _write_sub_text(self, f, indent, head, subs):
+        # Write the text of a component that contains the given sub
+        # components, one per line, between the head and a closing paren.
+        f.write(indent + head + '\n')
+        sub_indent = indent + '    '
+        for sub in subs:
+            if isinstance(sub, WASMComponent):
+                sub._write_text(f, sub_indent)
+            else:
+                f.write(sub_indent + repr(sub) + '\n')
+        f.write(indent + ')\n')
+    
+    def _write_wat(self, f):
+        raise NotImplementedError('Only modules can be written in the WebAssembly text format.')
+    
+    def invalidate(self):
+        """ Clear the cached binary representation of this component and of
+        the components that contain it. Setting attributes of components, and
+        modifying their lists and dicts (e.g. the instructions and locals of a
+        function definition, or the sections of a module) is tracked
+        automatically, and Instruction objects are immutable. Call this e.g.
+        after modifying the buffer of a data section in-place.
+        """
+        parent = getattr(self, '_parent', None)
+        if parent is not None:
+            parent.invalidate()
+    
+    def _get_size(self):
+        """ Get the number of bytes of the binary representation.
         Implemented in the subclasses.
         """
         raise NotImplementedError()
+    
+    def _write_into(self, bb, pos):
+        """ Write the binary representation into bytearray bb at the
+        given position, and return the new position. Implemented in the
+        subclasses.
+        """
+        raise NotImplementedError()
 
 
-class Module(WASMComponent):
+class Module(_Tracked, WASMComponent):
     """ Class to represent a WASM module; the toplevel unit of code.
     The subcomponents of a module are objects that derive from `Section`.
     It is recommended to provide `Function` and `ImportedFunction` objects,
     from which the module will polulate the function-related sections, and
     handle the binding of the function index space.
+    
+    The module keeps the encoded bytes of its function definitions and
+    (smaller) sections, so that re-encoding it after a change only encodes
+    what has been modified. Calls to functions by name are resolved when
+    the module is linked (which happens automatically when it is encoded).
     """
     
-    __slots__ = ['sections', 'func_id_to_index']
+    __slots__ = ['sections', 'func_id_to_index', '_index_version']
     
     def __init__(self, *sections):
+        self._index_version = next(_INDEX_VERSIONS)
+        self.func_id_to_index = {}
         # Process sections, filter out high-level functions
         self.sections = []
         has_lowlevel_funcs = False
@@ -204,49 +697,48 @@ class Module(WASMComponent):
         
         # Sort the sections
         self.sections.sort(key=lambda x: x.id)
-        
-        # Prepare functiondefs
-        for section in reversed(self.sections):
-            if isinstance(section, CodeSection):
-                for funcdef in section.functiondefs:
-                    funcdef.module = self
-                break 
     
     def _process_functions(self, functions, start_section, import_section, export_section):
         
         # Prepare processing functions. In the order of imported and then defined,
-        # because that's the order of the function index space. We use the function
-        # index also for the signature index, though that's not strictly necessary
-        # (e.g. functions can share a signature).
+        # because that's the order of the function index space. Functions with
+        # the same signature share an entry in the type section.
         # Function index space is used in, calls, exports, elementes, start function.
         auto_sigs = []
+        sig_indices = {}  # (params, returns) -> signature index
         auto_defs = []
+        auto_def_sigs = []
         auto_imports = []
         auto_exports = []
         auto_start = None
         function_index = 0
-        self.func_id_to_index = {}
+        func_id_to_index = {}
         # Process imported functions
         for func in functions:
             if isinstance(func, ImportedFuncion):
-                auto_sigs.append(FunctionSig(func.params, func.returns))
-                auto_imports.append(Import(func.modname, func.fieldname, 'function', function_index))
+                sig_index = self._get_sig_index(func, auto_sigs, sig_indices)
+                auto_imports.append(Import(func.modname, func.fieldname, 'function', sig_index))
                 if func.export:
-                    auto_exports.append((func.idname, 'function', function_index))
-                self.func_id_to_index[func.idname] = function_index
+                    auto_exports.append(Export(func.idname, 'function', function_index))
+                func_id_to_index[func.idname] = function_index
                 function_index += 1
         # Process defined functions
         for func in functions:
             if isinstance(func, Function):
-                auto_sigs.append(FunctionSig(func.params, func.returns))
-                auto_defs.append(FunctionDef(func.locals, *func.instructions))
+                auto_def_sigs.append(self._get_sig_index(func, auto_sigs, sig_indices))
+                if isinstance(func.instructions, InstructionBuffer):
+                    auto_defs.append(FunctionDef(func.locals, func.instructions))
+                else:
+                    auto_defs.append(FunctionDef(func.locals, *func.instructions))
                 if func.export:
-                    auto_exports.append((func.idname, 'function', function_index))
+                    auto_exports.append(Export(func.idname, 'function', function_index))
                 if func.idname == '$main' and start_section is None:
                     auto_start = StartSection(function_index)
-                self.func_id_to_index[func.idname] = function_index
+                func_id_to_index[func.idname] = function_index
                 function_index += 1
         
+        self.func_id_to_index = func_id_to_index
+        
         # Insert auto-generated function sigs and defs
         self.sections.append(TypeSection(*auto_sigs))
         self.sections.append(CodeSection(*auto_defs))
@@ -261,19 +753,472 @@ class Module(WASMComponent):
             self.sections.append(export_section)
         export_section.exports.extend(auto_exports)
         # Insert function section
-        self.sections.append(FunctionSection(*range(len(auto_imports), function_index)))
+        self.sections.append(FunctionSection(*auto_def_sigs))
         # Insert start section
         if auto_start is not None:
             self.sections.append(auto_start)
     
-    def to_text(self):
-        return 'Module(\n' + self._get_sub_text(self.sections, True) + '\n)'
+    def _get_sig_index(self, func, sigs, sig_indices):
+        # Get the signature index for the given function, reusing existing
+        # signatures with the same params and returns.
+        key = tuple(func.params), tuple(func.returns)
+        index = sig_indices.get(key)
+        if index is None:
+            index = sig_indices[key] = len(sigs)
+            sigs.append(FunctionSig(func.params, func.returns))
+        return index
+    
+    @classmethod
+    def from_bytes(cls, data, lazy=False):
+        """ Create a module from its binary representation, given as bytes
+        or any other object that supports the buffer protocol. The data is
+        not copied; sections and function bodies refer to it (via a
+        memoryview) until they are modified, so that encoding the module
+        again produces the exact same bytes. Sections that cannot be
+        represented with the section classes become a RawSection. The
+        `func_id_to_index` is populated from the exported functions.
+        
+        If lazy is True, function bodies are only located when the function
+        definitions are first accessed, and their locals and instructions
+        are decoded when first accessed. Function bodies that are not
+        modified are written verbatim.
+        """
+        bb = memoryview(data).cast('B')
+        if bytes(bb[:8]) != b'\x00asm' + packu32(1):
+            raise ValueError('Data is not a WASM module (version 1).')
+        sections = []
+        pos = 8
+        try:
+            while pos < len(bb):
+                section, pos = _read_section(bb, pos, lazy)
+                sections.append(section)
+        except IndexError:
+            raise ValueError('Unexpected end of WASM data.') from None
+        module = cls()
+        module.sections = sections
+        for section in sections:
+            if isinstance(section, ExportSection):
+                for export in section.exports:
+                    module.func_id_to_index[export.name] = export.index
+        return module
+    
+    @classmethod
+    def from_file(cls, f, lazy=False, use_mmap=False):
+        """ Create a module from a file (or file-like object) that contains
+        a binary WASM module. See from_bytes().
+        
+        If use_mmap is True, the file (which must be a real file) is memory
+        mapped instead of read. The sections and function bodies are then
+        backed by the mapping, and only the parts that are used are loaded
+        into memory. In combination with lazy=True this allows working with
+        very large modules. The file must not be modified (or overwritten
+        with the result) while the module is in use.
+        """
+        if use_mmap:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = f.read()
+        return cls.from_bytes(data, lazy)
+    
+    def _write_text(self, f, indent):
+        self._write_sub_text(f, indent, 'Module(', self.sections)
+    
+    def _write_wat(self, f):
+        names = {index: _get_wat_id(name) for name, index in self.func_id_to_index.items()}
+        indices = ()
+        for section in self.sections:
+            if isinstance(section, FunctionSection):
+                indices = section.indices
+        func_index = 0
+        
+        f.write('(module\n')
+        for section in self.sections:
+            if isinstance(section, TypeSection):
+                for i, functionsig in enumerate(section.functionsigs):
+                    f.write('  (type (;%i;) (func%s))\n' % (i, _get_wat_signature(functionsig)))
+            elif isinstance(section, ImportSection):
+                for imp in section.imports:
+                    f.write('  (import %s %s (func %s(;%i;) (type %i)))\n' %
+                            (_get_wat_string(imp.modname), _get_wat_string(imp.fieldname),
+                             names.get(func_index, ''), func_index, imp.type))
+                    func_index += 1
+            elif isinstance(section, CodeSection):
+                for i, funcdef in enumerate(section.functiondefs):
+                    f.write('  (func %s(;%i;)' % (names.get(func_index, ''), func_index))
+                    if i < len(indices):
+                        f.write(' (type %i)' % indices[i])
+                        for functionsig in self.sections:
+                            if isinstance(functionsig, TypeSection) and indices[i] < len(functionsig.functionsigs):
+                                f.write(_get_wat_signature(functionsig.functionsigs[indices[i]]))
+                    if funcdef.locals:
+                        f.write(' (local %s)' % ' '.join(funcdef.locals))
+                    f.write('\n')
+                    _write_wat_instructions(f, funcdef.instructions, names)
+                    f.write('  )\n')
+                    func_index += 1
+            elif isinstance(section, MemorySection):
+                for entrie in section.entries:
+                    if isinstance(entrie, int):
+                        entrie = (entrie, )
+                    f.write('  (memory (;0;) %s)\n' % ' '.join(str(i) for i in entrie))
+            elif isinstance(section, ExportSection):
+                for export in section.exports:
+                    f.write('  (export %s (func %i))\n' % (_get_wat_string(export.name), export.index))
+            elif isinstance(section, StartSection):
+                f.write('  (start %i)\n' % section.index)
+            elif isinstance(section, DataSection):
+                for chunk in section.chunks:
+                    f.write('  (data (i32.const %i) "' % chunk[1])
+                    with memoryview(chunk[2]) as view, view.cast('B') as data:
+                        for i in range(0, len(data), 4096):
+                            f.write(''.join(map(_WAT_ESCAPED_BYTES.__getitem__, data[i:i + 4096])))
+                    f.write('")\n')
+            elif not isinstance(section, FunctionSection):
+                f.write('  ;; %s\n' % section.to_text())
+        f.write(')\n')
+    
+    def invalidate(self):
+        # The sections or the function index space may have changed. Function
+        # definitions that call functions by name must then be linked again.
+        self._index_version = next(_INDEX_VERSIONS)
+    
+    def link(self):
+        """ Resolve all calls to functions by name into function indices,
+        using `func_id_to_index`. Function definitions that call by name
+        get a resolved copy that is independent of the module. All
+        unresolved names are reported in a single ValueError. This is done
+        automatically when the module is encoded; only function definitions
+        that changed (or all, if the function index space changed) are
+        resolved again.
+        """
+        version = self._index_version
+        unresolved = []
+        for section in self.sections:
+            # Unmodified decoded code sections call by index
+            if isinstance(section, CodeSection) and getattr(section, '_raw', None) is None:
+                for i, funcdef in enumerate(section.functiondefs):
+                    funcdef._link(self.func_id_to_index, version, unresolved, i)
+        if unresolved:
+            raise ValueError('Cannot resolve calls by name: ' +
+                             ', '.join('%r in function %i' % (name, i) for i, name in unresolved))
+    
+    def digest(self):
+        """ Get a structural hash of the module (32 bytes), computed from
+        its sections and the names in `func_id_to_index`. The code section
+        contributes the digests of the function definitions, so that the
+        module is not encoded to compute it. Sections and function
+        definitions cache their digest until they are modified, so this
+        is cheap after the first call.
+        """
+        h = blake2b(digest_size=32)
+        for section in self.sections:
+            h.update(section._get_digest())
+        for name, index in sorted(self.func_id_to_index.items()):
+            h.update(packstr(name) + packu32(index))
+        return h.digest()
+    
+    def validate(self):
+        """ Check that the module is valid, without compiling or running it.
+        The function definitions are type-checked in a single pass over
+        their instructions, checking the types on the stack, the types of
+        blocks and branches, and the indices of locals, functions and
+        signatures. All errors are reported in a single ValueError, with
+        the (function and instruction) position of each error. Returns a
+        list with the maximum stack depth of each function definition.
+        """
+        errors = []
+        functionsigs, imports, indices, functiondefs = (), (), (), ()
+        has_memory = False
+        for section in self.sections:
+            if isinstance(section, TypeSection):
+                functionsigs = section.functionsigs
+            elif isinstance(section, ImportSection):
+                imports = section.imports
+            elif isinstance(section, FunctionSection):
+                indices = section.indices
+            elif isinstance(section, CodeSection):
+                functiondefs = section.functiondefs
+            elif isinstance(section, MemorySection):
+                has_memory = True
+            elif isinstance(section, RawSection) and section.id in (1, 2, 3, 10):
+                errors.append('section %i is not supported by the validator' % section.id)
+        
+        # Get the signature of each function in the function index space
+        func_sigs = []
+        for i, sig_index in enumerate([imp.type for imp in imports] + list(indices)):
+            if sig_index < len(functionsigs):
+                func_sigs.append(functionsigs[sig_index])
+            else:
+                errors.append('function %i: signature index %i out of range' % (i, sig_index))
+                func_sigs.append(None)
+        if len(indices) != len(functiondefs):
+            errors.append('function section has %i entries, but code section has %i' %
+                          (len(indices), len(functiondefs)))
+        for section in self.sections:
+            if isinstance(section, ExportSection):
+                for export in section.exports:
+                    if export.index >= len(func_sigs):
+                        errors.append('export %r: function index %i out of range' %
+                                      (export.name, export.index))
+            elif isinstance(section, StartSection):
+                if section.index >= len(func_sigs):
+                    errors.append('start function index %i out of range' % section.index)
+                elif func_sigs[section.index] is not None and (
+                        func_sigs[section.index].params or func_sigs[section.index].returns):
+                    errors.append('start function %i must not have params or returns' % section.index)
+        
+        # Check the function bodies
+        max_depths = []
+        for i, funcdef in enumerate(functiondefs):
+            func_index = len(imports) + i
+            sig = func_sigs[func_index] if func_index < len(func_sigs) else None
+            if sig is None:
+                max_depths.append(0)
+            else:
+                max_depths.append(_validate_functiondef(funcdef, sig, func_sigs, functionsigs,
+                                                        self.func_id_to_index, has_memory,
+                                                        errors, func_index))
+        if errors:
+            raise ValueError('Invalid module:\n  ' + '\n  '.join(errors))
+        return max_depths
+    
+    def sort_locals(self):
+        """ Reorder the locals of all function definitions by type, so that
+        each function needs only one local declaration per type. See
+        FunctionDef.sort_locals().
+        """
+        functionsigs, indices = [], []
+        for section in self.sections:
+            if isinstance(section, TypeSection):
+                functionsigs = section.functionsigs
+            elif isinstance(section, FunctionSection):
+                indices = section.indices
+        for section in self.sections:
+            if isinstance(section, CodeSection):
+                for funcdef, index in zip(section.functiondefs, indices):
+                    funcdef.sort_locals(len(functionsigs[index].params))
+    
+    def optimize(self, passes=None):
+        """ Optimize all function definitions, using the given passes (by
+        default `wasmfun.optimize.DEFAULT_PASSES`). Each pass is called with
+        a function definition, the number of parameters of the function and
+        its result types.
+        Returns the number of function definitions that were changed.
+        """
+        if passes is None:
+            from .optimize import DEFAULT_PASSES as passes  # optimize imports this module
+        functionsigs, indices = [], []
+        for section in self.sections:
+            if isinstance(section, TypeSection):
+                functionsigs = section.functionsigs
+            elif isinstance(section, FunctionSection):
+                indices = section.indices
+        count = 0
+        for section in self.sections:
+            if isinstance(section, CodeSection):
+                for funcdef, index in zip(section.functiondefs, indices):
+                    sig = functionsigs[index]
+                    changed = False
+                    for pass_ in passes:
+                        changed = pass_(funcdef, len(sig.params), list(sig.returns)) or changed
+                    count += changed
+        return count
+    
+    def to_bytes(self, workers=None):
+        """ Get the bytes that represent the binary WASM for this module.
+        If workers is given, the function bodies that need encoding are
+        encoded in parallel using a pool of that many processes.
+        """
+        self.link()
+        if workers and workers > 1:
+            self._encode_functions_in_parallel(workers)
+        return super().to_bytes()
+    
+    def _encode_functions_in_parallel(self, workers):
+        # Collect (linked) function definitions that need encoding
+        funcdefs = []
+        for section in self.sections:
+            if isinstance(section, CodeSection) and getattr(section, '_raw', None) is None:
+                for funcdef in section.functiondefs:
+                    funcdef = funcdef._get_linked()
+                    if funcdef._cache is None:
+                        funcdefs.append(funcdef)
+        if not funcdefs:
+            return
+        # Encode in chunks, the result is stored in the caches of the funcdefs.
+        # Pickling instructions is much slower than encoding them, so if we
+        # can fork, the workers get the funcdefs from the inherited memory.
+        global _parallel_funcdefs
+        chunksize = max(1, len(funcdefs) // (workers * 4))
+        ranges = [range(i, min(i + chunksize, len(funcdefs)))
+                  for i in range(0, len(funcdefs), chunksize)]
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+            chunks = ranges
+        else:
+            context = None
+            chunks = [[funcdefs[i] for i in r] for r in ranges]
+        _parallel_funcdefs = funcdefs
+        try:
+            with ProcessPoolExecutor(workers, context) as executor:
+                results = executor.map(_encode_functiondefs, chunks)
+                for r, encoded_bodies in zip(ranges, results):
+                    for i, encoded_body in zip(r, encoded_bodies):
+                        funcdefs[i]._cache = encoded_body
+        finally:
+            _parallel_funcdefs = None
     
     def to_file(self, f):
-        f.write(b'\x00asm')
-        f.write(packu32(1))  # version, must be 1 for now
+        """ Write the binary representation of this module to a file (or
+        any file-like object, e.g. a pipe). The sections are written one by
+        one, and function bodies that are not cached are encoded one at a
+        time, so that the whole binary is never held in memory.
+        """
+        self.link()
+        f.write(b'\x00asm' + packu32(1))  # magic and version (must be 1 for now)
+        for section in self.sections:
+            section._write_to_file(f)
+    
+    def _get_size(self):
+        self.link()
+        return 8 + sum(section._get_size() for section in self.sections)
+    
+    def _write_into(self, bb, pos):
+        bb[pos:pos + 8] = b'\x00asm' + packu32(1)  # magic and version (must be 1 for now)
+        pos += 8
         for section in self.sections:
-            section.to_file(f)
+            pos = section._write_into(bb, pos)
+        return pos
+
+
+class ModuleBuilder:
+    """ Append-only builder for a module, as an alternative to passing all
+    Function and ImportedFuncion objects to Module at once. Functions are
+    added one at a time and turned into FunctionDef objects right away, and
+    function indices are assigned as they are added (imported functions
+    must be added first, because they come first in the function index
+    space). Functions with the same signature share an entry in the type
+    section. Use to_module() or to_bytes() at the end.
+    
+    Like with Module, a function named '$main' becomes the start function
+    (unless a StartSection is added), and calls by name are resolved when
+    the module is linked.
+    """
+    
+    __slots__ = ['func_id_to_index', '_sigs', '_sig_indices', '_imports', '_func_sigs',
+                 '_functiondefs', '_exports', '_data', '_sections']
+    
+    def __init__(self):
+        self.func_id_to_index = {}
+        self._sigs = []
+        self._sig_indices = {}  # (params, returns) -> signature index
+        self._imports = []
+        self._func_sigs = []
+        self._functiondefs = []
+        self._exports = []  # (name, idname or index)
+        self._data = []
+        self._sections = []
+    
+    def _add_name(self, idname):
+        # Register the name of the next function. Returns its index.
+        assert isinstance(idname, str)
+        if idname in self.func_id_to_index:
+            raise ValueError('Duplicate function name %r.' % idname)
+        index = self.func_id_to_index[idname] = len(self._imports) + len(self._functiondefs)
+        return index
+    
+    def _get_sig_index(self, params, returns):
+        key = tuple(params), tuple(returns)
+        index = self._sig_indices.get(key)
+        if index is None:
+            index = self._sig_indices[key] = len(self._sigs)
+            self._sigs.append(FunctionSig(params, returns))
+        return index
+    
+    def add_import(self, idname, params, returns, modname, fieldname, export=False):
+        """ Add an imported function. Returns its function index.
+        """
+        if self._functiondefs:
+            raise ValueError('Imported functions must be added before defined functions.')
+        sig_index = self._get_sig_index(params, returns)
+        index = self._add_name(idname)
+        self._imports.append(Import(modname, fieldname, 'function', sig_index))
+        if export:
+            self._exports.append((idname, index))
+        return index
+    
+    def add_function(self, idname, params, returns, locals, instructions, export=False):
+        """ Add a function, with instructions given as a list (of Instruction
+        objects, strings and tuples) or an InstructionBuffer. Returns its
+        function index.
+        """
+        sig_index = self._get_sig_index(params, returns)
+        index = self._add_name(idname)
+        if isinstance(instructions, InstructionBuffer):
+            self._functiondefs.append(FunctionDef(locals, instructions))
+        else:
+            self._functiondefs.append(FunctionDef(locals, *instructions))
+        self._func_sigs.append(sig_index)
+        if export:
+            self._exports.append((idname, index))
+        return index
+    
+    def add_export(self, name, func):
+        """ Export a function, given by its name or index, under the given
+        name. The function may be added later.
+        """
+        self._exports.append((name, func))
+    
+    def add_data(self, offset, data):
+        """ Add data to put in memory at the given offset. Needs a
+        MemorySection (see add_section()).
+        """
+        self._data.append((0, offset, data))
+    
+    def add_section(self, section):
+        """ Add a section that is not produced by the builder itself, e.g. a
+        MemorySection or a StartSection.
+        """
+        if not isinstance(section, Section):
+            raise TypeError('ModuleBuilder.add_section() expects a Section.')
+        if isinstance(section, (TypeSection, ImportSection, FunctionSection,
+                                ExportSection, CodeSection, DataSection)):
+            raise ValueError('The builder produces the %s itself.' % section.__class__.__name__)
+        self._sections.append(section)
+    
+    def to_module(self):
+        """ Get a Module with the functions, exports and data added so far.
+        """
+        exports = []
+        for name, func in self._exports:
+            if isinstance(func, str):
+                if func not in self.func_id_to_index:
+                    raise ValueError('Cannot export unknown function %r.' % func)
+                func = self.func_id_to_index[func]
+            exports.append(Export(name, 'function', func))
+        sections = [TypeSection(*self._sigs), FunctionSection(*self._func_sigs),
+                    CodeSection(*self._functiondefs)]
+        if self._imports:
+            sections.append(ImportSection(*self._imports))
+        if exports:
+            sections.append(ExportSection(*exports))
+        if self._data:
+            sections.append(DataSection(*self._data))
+        sections.extend(self._sections)
+        if '$main' in self.func_id_to_index and not any(isinstance(section, StartSection)
+                                                        for section in self._sections):
+            sections.append(StartSection(self.func_id_to_index['$main']))
+        sections.sort(key=lambda x: x.id)
+        module = Module()
+        module.sections = sections
+        module.func_id_to_index = dict(self.func_id_to_index)
+        return module
+    
+    def to_bytes(self):
+        """ Get the binary WASM module for the functions, exports and data
+        added so far.
+        """
+        return self.to_module().to_bytes()
 
 
 class Function:
@@ -288,7 +1233,7 @@ class Function:
         assert isinstance(params, (tuple, list))
         assert isinstance(returns, (tuple, list))
         assert isinstance(locals, (tuple, list))
-        assert isinstance(instructions, (tuple, list))
+        assert isinstance(instructions, (tuple, list, InstructionBuffer))
         self.idname = idname
         self.params = params
         self.returns = returns
@@ -321,31 +1266,115 @@ class ImportedFuncion:
 ## Sections
 
 
-class Section(WASMComponent):
-    """Base class for module sections.
+class Section(_Tracked, WASMComponent):
+    """Base class for module sections. Subclasses implement
+    `_get_payload_size()` and `_write_payload()`.
     """
     
-    __slots__ = []
+    __slots__ = ['_payload_size', '_cache', '_raw', '_parent', '_digest']
     id = -1
+    _cacheable = True  # whether to cache the payload
     
     def to_text(self):
         return '%s()' % self.__class__.__name__
     
-    def to_file(self, f):
-        f2 = BytesIO()
-        self.get_binary_section(f2)
-        payload = f2.getvalue()
+    def get_binary_section(self, f):
+        """ Write the payload of this section (without the section header)
+        to a file.
+        """
+        bb = bytearray(self._get_payload_size())
+        self._write_payload(bb, 0)
+        f.write(bb)
+    
+    def _get_digest(self):
+        # Get the (cached) hash of this section
+        digest = getattr(self, '_digest', None)
+        if digest is None:
+            h = blake2b(digest_size=32)
+            self._update_digest(h)
+            digest = self._digest = h.digest()
+        return digest
+    
+    def _update_digest(self, h):
+        # Add the structure of this section to the given hash object
+        h.update(self.to_bytes())
+    
+    def _get_custom_name(self):
+        # custom section for debugging, future, or extension
+        return packstr(self.__class__.__name__.lower().split('section')[0])
+    
+    def invalidate(self):
+        self._cache = None
+        self._raw = None
+        self._digest = None
+        super().invalidate()
+    
+    @classmethod
+    def _read_payload(cls, bb, pos, end, lazy):
+        # Read a section of this class from its payload. Returns (section,
+        # new_position). The section is None if it cannot be represented.
+        # If lazy, parts of the section may be decoded on first access.
+        return None, pos
+    
+    def _get_size(self):
         id = self.id
         assert id >= 0
-        # Write it all
-        f.write(packvu7(id))
-        f.write(packvu32(len(payload)))
-        if id == 0:  # custom section for debugging, future, or extension
-            type = self.__cass__.__name__.lower().split('section')[0]
-            f.write(pack_str(type))
-        f.write(payload)
+        raw = getattr(self, '_raw', None)
+        if raw is not None:
+            return len(raw)  # the original bytes of a decoded section
+        if not self._cacheable:
+            size = self._get_payload_size()
+        else:
+            if getattr(self, '_cache', None) is None:
+                bb = bytearray(self._get_payload_size())
+                self._write_payload(bb, 0)
+                self._cache = bb
+            size = len(self._cache)
+        if id == 0:
+            size += len(self._get_custom_name())
+        self._payload_size = size  # used in _write_into()
+        return 1 + uleb_size(size) + size
+    
+    def _write_into(self, bb, pos):
+        raw = getattr(self, '_raw', None)
+        if raw is not None:
+            return write_bytes(bb, pos, raw)
+        bb[pos] = self.id
+        pos = write_uleb(bb, pos + 1, self._payload_size)
+        if self.id == 0:
+            pos = write_bytes(bb, pos, self._get_custom_name())
+        if not self._cacheable:
+            return self._write_payload(bb, pos)
+        return write_bytes(bb, pos, self._cache)
+    
+    def _write_to_file(self, f):
+        # Write the whole section to a file
+        raw = getattr(self, '_raw', None)
+        if raw is not None:
+            f.write(raw)
+        else:
+            self._write_parts_to_file(f)
+    
+    def _write_parts_to_file(self, f):
+        # Sections that can be large overload this to write their payload in parts
+        bb = bytearray(self._get_size())
+        self._write_into(bb, 0)
+        f.write(bb)
+    
+    def _write_header_to_file(self, f, payload_size):
+        # Write the section header for the given payload size (excluding
+        # the name of custom sections) to a file.
+        name = self._get_custom_name() if self.id == 0 else b''
+        payload_size += len(name)
+        bb = bytearray(1 + uleb_size(payload_size))
+        bb[0] = self.id
+        write_uleb(bb, 1, payload_size)
+        f.write(bb + name)
+    
+    def _get_payload_size(self):
+        raise NotImplementedError()  # Sections need to implement this
     
-    def get_binary_section(self, f):
+    def _write_payload(self, bb, pos):
         raise NotImplementedError()  # Sections need to implement this
 
 
@@ -363,13 +1392,34 @@ class TypeSection(Section):
             functionsig.index = i  # so we can resolve the index in Import objects
         self.functionsigs = functionsigs
     
-    def to_text(self):
-        return 'TypeSection(\n' + self._get_sub_text(self.functionsigs, True) + '\n)'
-    
-    def get_binary_section(self, f):
-        f.write(packvu32(len(self.functionsigs)))  # count
+    def _write_text(self, f, indent):
+        self._write_sub_text(f, indent, 'TypeSection(', self.functionsigs)
+    
+    @classmethod
+    def _read_payload(cls, bb, pos, end, lazy):
+        count, pos = read_uleb(bb, pos)
+        functionsigs = []
+        for i in range(count):
+            if bb[pos] != 0x60:
+                return None, pos  # only function signatures are supported
+            params, pos = _read_types(bb, pos + 1)
+            returns, pos = _read_types(bb, pos)
+            functionsigs.append(FunctionSig(params, returns))
+        section = cls(*functionsigs)
+        for functionsig in functionsigs:
+            functionsig._parent = section
+        return section, pos
+    
+    def _get_payload_size(self):
+        return (uleb_size(len(self.functionsigs)) +
+                sum(functionsig._get_size() for functionsig in self.functionsigs))
+    
+    def _write_payload(self, bb, pos):
+        pos = write_uleb(bb, pos, len(self.functionsigs))  # count
         for functionsig in self.functionsigs:
-            functionsig.to_file(f)
+            functionsig._parent = self
+            pos = functionsig._write_into(bb, pos)
+        return pos
 
 
 class ImportSection(Section):
@@ -383,13 +1433,34 @@ class ImportSection(Section):
             assert isinstance(imp, Import)
         self.imports = list(imports)
     
-    def to_text(self):
-        return 'ImportSection(\n' + self._get_sub_text(self.imports, True) + '\n)'
+    def _write_text(self, f, indent):
+        self._write_sub_text(f, indent, 'ImportSection(', self.imports)
+    
+    @classmethod
+    def _read_payload(cls, bb, pos, end, lazy):
+        count, pos = read_uleb(bb, pos)
+        imports = []
+        for i in range(count):
+            modname, pos = _read_str(bb, pos)
+            fieldname, pos = _read_str(bb, pos)
+            if bb[pos] != 0:
+                return None, pos  # only functions can be imported for now
+            type, pos = read_uleb(bb, pos + 1)
+            imports.append(Import(modname, fieldname, 'function', type))
+        section = cls(*imports)
+        for imp in imports:
+            imp._parent = section
+        return section, pos
     
-    def get_binary_section(self, f):
-        f.write(packvu32(len(self.imports)))  # count
+    def _get_payload_size(self):
+        return uleb_size(len(self.imports)) + sum(imp._get_size() for imp in self.imports)
+    
+    def _write_payload(self, bb, pos):
+        pos = write_uleb(bb, pos, len(self.imports))  # count
         for imp in self.imports:
-            imp.to_file(f)
+            imp._parent = self
+            pos = imp._write_into(bb, pos)
+        return pos
 
 
 class FunctionSection(Section):
@@ -409,10 +1480,23 @@ class FunctionSection(Section):
     def to_text(self):
         return 'FunctionSection(' + ', '.join([str(i) for i in self.indices]) + ')'
     
-    def get_binary_section(self, f):
-        f.write(packvu32(len(self.indices)))
+    @classmethod
+    def _read_payload(cls, bb, pos, end, lazy):
+        count, pos = read_uleb(bb, pos)
+        indices = []
+        for i in range(count):
+            index, pos = read_uleb(bb, pos)
+            indices.append(index)
+        return cls(*indices), pos
+    
+    def _get_payload_size(self):
+        return uleb_size(len(self.indices)) + sum(uleb_size(i) for i in self.indices)
+    
+    def _write_payload(self, bb, pos):
+        pos = write_uleb(bb, pos, len(self.indices))
         for i in self.indices:
-            f.write(packvu32(i))
+            pos = write_uleb(bb, pos, i)
+        return pos
 
 
 class TableSection(Section):
@@ -437,19 +1521,40 @@ class MemorySection(Section):
     def to_text(self):
         return 'MemorySection(' + ', '.join([str(i) for i in self.entries]) + ')'
     
-    def get_binary_section(self, f):
-        f.write(packvu32(len(self.entries)))
+    @classmethod
+    def _read_payload(cls, bb, pos, end, lazy):
+        count, pos = read_uleb(bb, pos)
+        if count != 1 or bb[pos] not in (0, 1):
+            return None, pos  # one memory in MVP
+        has_max = bb[pos]
+        initial, pos = read_uleb(bb, pos + 1)
+        if has_max:
+            maximum, pos = read_uleb(bb, pos)
+            return cls((initial, maximum)), pos
+        return cls((initial, )), pos
+    
+    def _get_payload_size(self):
+        size = uleb_size(len(self.entries))
+        for entrie in self.entries:
+            if isinstance(entrie, int):
+                entrie = (entrie, )
+            size += 1 + sum(uleb_size(i) for i in entrie[:2])  # flag + limits
+        return size
+    
+    def _write_payload(self, bb, pos):
+        pos = write_uleb(bb, pos, len(self.entries))
         for entrie in self.entries:
             # resizable_limits
             if isinstance(entrie, int):
                 entrie = (entrie, )
             if len(entrie) == 1:
-                f.write(packvu1(0))
-                f.write(packvu32(entrie[0]))  # initial, no max
+                bb[pos] = 0
+                pos = write_uleb(bb, pos + 1, entrie[0])  # initial, no max
             else:
-                f.write(packvu1(1))
-                f.write(packvu32(entrie[0]))  # initial
-                f.write(packvu32(entrie[1]))  # maximum
+                bb[pos] = 1
+                pos = write_uleb(bb, pos + 1, entrie[0])  # initial
+                pos = write_uleb(bb, pos, entrie[1])  # maximum
+        return pos
 
 
 class GlobalSection(Section):
@@ -470,13 +1575,33 @@ class ExportSection(Section):
             assert isinstance(export, Export)
         self.exports = list(exports)
     
-    def to_text(self):
-        return 'ExportSection(\n' + self._get_sub_text(self.exports, True) + '\n)'
+    def _write_text(self, f, indent):
+        self._write_sub_text(f, indent, 'ExportSection(', self.exports)
+    
+    @classmethod
+    def _read_payload(cls, bb, pos, end, lazy):
+        count, pos = read_uleb(bb, pos)
+        exports = []
+        for i in range(count):
+            name, pos = _read_str(bb, pos)
+            if bb[pos] != 0:
+                return None, pos  # only functions can be exported for now
+            index, pos = read_uleb(bb, pos + 1)
+            exports.append(Export(name, 'function', index))
+        section = cls(*exports)
+        for export in exports:
+            export._parent = section
+        return section, pos
     
-    def get_binary_section(self, f):
-        f.write(packvu32(len(self.exports)))
+    def _get_payload_size(self):
+        return uleb_size(len(self.exports)) + sum(export._get_size() for export in self.exports)
+    
+    def _write_payload(self, bb, pos):
+        pos = write_uleb(bb, pos, len(self.exports))
         for export in self.exports:
-            export.to_file(f)
+            export._parent = self
+            pos = export._write_into(bb, pos)
+        return pos
     
 
 class StartSection(Section):
@@ -493,8 +1618,16 @@ class StartSection(Section):
     def to_text(self):
         return 'StartSection(' + str(self.index) + ')'
     
-    def get_binary_section(self, f):
-        f.write(packvu32(self.index))
+    @classmethod
+    def _read_payload(cls, bb, pos, end, lazy):
+        index, pos = read_uleb(bb, pos)
+        return cls(index), pos
+    
+    def _get_payload_size(self):
+        return uleb_size(self.index)
+    
+    def _write_payload(self, bb, pos):
+        return write_uleb(bb, pos, self.index)
 
 
 class ElementSection(Section):
@@ -507,61 +1640,229 @@ class ElementSection(Section):
 class CodeSection(Section):
     """ The actual code for a module, one CodeSection per function.
     """
-    __slots__ = ['functiondefs']
+    __slots__ = ['functiondefs', '_body']
     id = 10
+    _cacheable = False  # the function definitions cache their bytes
     
     def __init__(self, *functiondefs):
+        self._body = None
         for functiondef in functiondefs:
             assert isinstance(functiondef, FunctionDef)
         self.functiondefs = functiondefs
     
-    def to_text(self):
-        return 'CodeSection(\n' + self._get_sub_text(self.functiondefs, True) + '\n)'
+    def _write_text(self, f, indent):
+        self._write_sub_text(f, indent, 'CodeSection(', self.functiondefs)
     
-    def get_binary_section(self, f):
-        f.write(packvu32(len(self.functiondefs)))
+    def _update_digest(self, h):
+        h.update(bytes([self.id]) + packu32(len(self.functiondefs)))
         for functiondef in self.functiondefs:
-            functiondef.to_file(f)
+            functiondef._parent = self  # so that changes clear the digest
+            h.update(functiondef.digest())
+    
+    @classmethod
+    def _read_payload(cls, bb, pos, end, lazy):
+        if lazy:
+            # The function bodies are located when they are first accessed
+            section = cls.__new__(cls)
+            section._body = bb[pos:end]
+            return section, end
+        functiondefs, pos = cls._read_functiondefs(bb, pos, False)
+        section = cls(*functiondefs)
+        for functiondef in functiondefs:
+            functiondef._parent = section
+        return section, pos
+    
+    @staticmethod
+    def _read_functiondefs(bb, pos, lazy):
+        count, pos = read_uleb(bb, pos)
+        functiondefs = []
+        for i in range(count):
+            functiondef, pos = FunctionDef._read(bb, pos, lazy)
+            functiondefs.append(functiondef)
+        return functiondefs, pos
+    
+    def __getattr__(self, name):
+        # Only called for attributes that are not set. The function definitions
+        # of a lazily decoded code section are created on first access.
+        if name == 'functiondefs' and getattr(self, '_body', None) is not None:
+            functiondefs, pos = self._read_functiondefs(self._body, 0, True)
+            if pos != len(self._body):
+                raise ValueError('Code section has %i bytes, but %i are used.' %
+                                 (len(self._body), pos))
+            for functiondef in functiondefs:
+                functiondef._parent = self
+            self._body = None
+            object.__setattr__(self, 'functiondefs', tuple(functiondefs))
+            return self.functiondefs
+        raise AttributeError('%r object has no attribute %r' % (self.__class__.__name__, name))
+    
+    def _get_payload_size(self):
+        size = uleb_size(len(self.functiondefs))
+        for functiondef in self.functiondefs:
+            functiondef._parent = self
+            size += functiondef._get_linked()._get_size()
+        return size
+    
+    def _write_payload(self, bb, pos):
+        pos = write_uleb(bb, pos, len(self.functiondefs))
+        for functiondef in self.functiondefs:
+            pos = functiondef._get_linked()._write_into(bb, pos)
+        return pos
+    
+    def _write_parts_to_file(self, f):
+        # Determine sizes without encoding (or caching) the function bodies.
+        # Then encode and write the bodies one by one.
+        count = len(self.functiondefs)
+        size = uleb_size(count)
+        for functiondef in self.functiondefs:
+            functiondef._parent = self
+            size += functiondef._get_linked()._get_size_without_caching()
+        self._write_header_to_file(f, size)
+        f.write(unsigned_leb128_encode(count))
+        for functiondef in self.functiondefs:
+            functiondef._get_linked()._write_to_file(f)
 
 
 class DataSection(Section):
     """ Initialize the linear memory.
     Note that the initial contents of linear memory are zero.
+    
+    Each chunk is a tuple (memory index, offset, data). The data can be any
+    (contiguous) object that supports the buffer protocol, e.g. bytes,
+    bytearray, memoryview, mmap or a NumPy array. It is not copied, but
+    written directly to the output when the module is encoded.
     """
     
     __slots__ = ['chunks']
     id = 11
+    _cacheable = False  # the data is usually large and changes rarely
     
     def __init__(self, *chunks):
-        self.chunks = []
         for chunk in chunks:
-            assert len(chunk) == 3  # index, offset, bytes
+            assert len(chunk) == 3  # index, offset, data
             assert chunk[0] == 0  # always 0 in MVP
-            assert isinstance(chunk[2], bytes)
+            with memoryview(chunk[2]) as view:
+                if not view.c_contiguous:
+                    raise ValueError('DataSection data must be contiguous.')
+        self.chunks = [tuple(chunk) for chunk in chunks]
     
     def to_text(self):
-        chunkinfo = [(chunk[0], chunk[1], len(chunk[2])) for chunk in self.chunks]
+        chunkinfo = [(chunk[0], chunk[1], _get_nbytes(chunk[2])) for chunk in self.chunks]
         return 'DataSection(' + ', '.join([str(i) for i in chunkinfo]) + ')'
     
-    def get_binary_section(self, f):
-        f.write(packvu32(len(self.chunks)))
+    def _update_digest(self, h):
+        # Hash the data directly, instead of copying it into the encoded section
+        h.update(bytes([self.id]) + packu32(len(self.chunks)))
+        for index, offset, data in self.chunks:
+            with memoryview(data) as view:
+                view = view.cast('B')
+                h.update(spack('<Iiq', index, offset, view.nbytes))
+                h.update(view)
+    
+    @classmethod
+    def _read_payload(cls, bb, pos, end, lazy):
+        count, pos = read_uleb(bb, pos)
+        chunks = []
+        for i in range(count):
+            index, pos = read_uleb(bb, pos)
+            if index != 0 or bb[pos] != 0x41:
+                return None, pos  # memory 0 and an i32.const offset in MVP
+            offset, pos = read_sleb(bb, pos + 1)
+            if bb[pos] != 0x0b:
+                return None, pos
+            size, pos = read_uleb(bb, pos + 1)
+            chunks.append((index, offset, bb[pos:pos + size]))
+            pos += size
+        return cls(*chunks), pos
+    
+    def _get_chunk_header_size(self, chunk, nbytes):
+        # memory index, init expression (i32.const offset, end), data size
+        return uleb_size(chunk[0]) + 1 + sleb_size(chunk[1]) + 1 + uleb_size(nbytes)
+    
+    def _write_chunk_header(self, bb, pos, chunk, nbytes):
+        pos = write_uleb(bb, pos, chunk[0])
+        bb[pos] = 0x41  # i32.const
+        pos = write_sleb(bb, pos + 1, chunk[1])
+        bb[pos] = 0x0b  # end
+        return write_uleb(bb, pos + 1, nbytes)
+    
+    def _get_payload_size(self):
+        size = uleb_size(len(self.chunks))
         for chunk in self.chunks:
-            f.write(packvu32(chunk[0]))
-            #ff.write(packvu32(chunk[1]))
-            Instruction('i32.const', chunk[1]).to_file(f)  # todo: is this right?
-            f.write(packvu32(len(chunk[2])))
+            nbytes = _get_nbytes(chunk[2])
+            size += self._get_chunk_header_size(chunk, nbytes) + nbytes
+        return size
+    
+    def _write_payload(self, bb, pos):
+        pos = write_uleb(bb, pos, len(self.chunks))
+        for chunk in self.chunks:
+            with memoryview(chunk[2]) as view, view.cast('B') as data:
+                pos = self._write_chunk_header(bb, pos, chunk, len(data))
+                pos = write_bytes(bb, pos, data)
+        return pos
+    
+    def _write_parts_to_file(self, f):
+        # Write the chunk headers, and the data directly from its buffer
+        self._write_header_to_file(f, self._get_payload_size())
+        f.write(unsigned_leb128_encode(len(self.chunks)))
+        for chunk in self.chunks:
+            with memoryview(chunk[2]) as view, view.cast('B') as data:
+                bb = bytearray(self._get_chunk_header_size(chunk, len(data)))
+                self._write_chunk_header(bb, 0, chunk, len(data))
+                f.write(bb)
+                f.write(data)
+
+
+class RawSection(Section):
+    """ A section given by its id and (binary) payload. Used for sections
+    that cannot be represented by the other section classes, e.g. custom
+    sections and unsupported sections in decoded modules. The payload of
+    a custom section includes its name.
+    """
+    
+    __slots__ = ['id', 'payload']
+    _cacheable = False  # the payload is already binary
+    
+    def __init__(self, id, payload):
+        self.id = id
+        self.payload = payload
+    
+    def to_text(self):
+        return 'RawSection(%i, <%i bytes>)' % (self.id, _get_nbytes(self.payload))
+    
+    def _get_custom_name(self):
+        return b''  # part of the payload
+    
+    def _get_payload_size(self):
+        return _get_nbytes(self.payload)
+    
+    def _write_payload(self, bb, pos):
+        with memoryview(self.payload) as view, view.cast('B') as data:
+            return write_bytes(bb, pos, data)
+
+
+# Map section id to section class, for decoding
+_SECTION_CLASSES = {cls.id: cls for cls in (
+    TypeSection, ImportSection, FunctionSection, TableSection, MemorySection, GlobalSection,
+    ExportSection, StartSection, ElementSection, CodeSection, DataSection)}
+
+
+def _get_nbytes(data):
+    # Get the size in bytes of an object that supports the buffer protocol
+    with memoryview(data) as view:
+        return view.nbytes
 
 
 ## Non-section components
 
 
-class Import(WASMComponent):
+class Import(_Tracked, WASMComponent):
     """ Import objects (from other wasm modules or from the host environment).
     The type argument is an index in the type-section (signature) for funcs
     and a string type for table, memory and global.
     """
     
-    __slots__ = ['modname', 'fieldname', 'kind', 'type']
+    __slots__ = ['modname', 'fieldname', 'kind', 'type', '_parent']
     
     def __init__(self, modname, fieldname, kind, type):
         self.modname = modname
@@ -572,24 +1873,26 @@ class Import(WASMComponent):
     def to_text(self):
         return 'Import(%r, %r, %r, %r)' % (self.modname, self.fieldname, self.kind, self.type)
     
-    def to_file(self, f):
-        f.write(packstr(self.modname))
-        f.write(packstr(self.fieldname))
-        if self.kind == 'function':
-            f.write(b'\x00')
-            f.write(packvu32(self.type))
-        else:
+    def _get_size(self):
+        if self.kind != 'function':
             raise RuntimeError('Can only import functions for now')
+        return len(packstr(self.modname)) + len(packstr(self.fieldname)) + 1 + uleb_size(self.type)
+    
+    def _write_into(self, bb, pos):
+        pos = write_bytes(bb, pos, packstr(self.modname))
+        pos = write_bytes(bb, pos, packstr(self.fieldname))
+        bb[pos] = 0  # function
+        return write_uleb(bb, pos + 1, self.type)
 
 
-class Export(WASMComponent):
+class Export(_Tracked, WASMComponent):
     """ Export an object defined in this module. The index is the index
     in the corresponding index space (e.g. for functions this is the
     function index space which is basically the concatenation of
     functions in the import and code sections).
     """
     
-    __slots__ = ['name', 'kind', 'index']
+    __slots__ = ['name', 'kind', 'index', '_parent']
     
     def __init__(self, name, kind, index):
         self.name = name
@@ -599,20 +1902,22 @@ class Export(WASMComponent):
     def to_text(self):
         return 'Export(%r, %r, %i)' % (self.name, self.kind, self.index)
     
-    def to_file(self, f):
-        f.write(packstr(self.name))
-        if self.kind == 'function':
-            f.write(b'\x00')
-            f.write(packvu32(self.index))
-        else:
+    def _get_size(self):
+        if self.kind != 'function':
             raise RuntimeError('Can only export functions for now')
+        return len(packstr(self.name)) + 1 + uleb_size(self.index)
+    
+    def _write_into(self, bb, pos):
+        pos = write_bytes(bb, pos, packstr(self.name))
+        bb[pos] = 0  # function
+        return write_uleb(bb, pos + 1, self.index)
 
 
-class FunctionSig(WASMComponent):
+class FunctionSig(_Tracked, WASMComponent):
     """ Defines the signature of a WASM module that is imported or defined in
     this module.
     """
-    __slots__ = ['params', 'returns', 'index']
+    __slots__ = ['params', 'returns', 'index', '_parent']
     
     def __init__(self, params=(), returns=()):
         self.params = params
@@ -622,83 +1927,349 @@ class FunctionSig(WASMComponent):
     def to_text(self):
         return 'FunctionSig(%r, %r)' % (list(self.params), list(self.returns))
     
-    def to_file(self, f):
-        f.write(b'\x60')  # form -> nonfunctions may also be supported in the future
-        f.write(packvu32(len(self.params)))  # params
+    def _get_size(self):
+        assert len(self.returns) <= 1
+        return 2 + uleb_size(len(self.params)) + len(self.params) + len(self.returns)
+    
+    def _write_into(self, bb, pos):
+        bb[pos] = 0x60  # form -> nonfunctions may also be supported in the future
+        pos = write_uleb(bb, pos + 1, len(self.params))  # params
         for paramtype in self.params:
-            f.write(LANG_TYPES[paramtype])
-        f.write(packvu1(len(self.returns)))  # returns
+            bb[pos] = LANG_TYPES[paramtype][0]
+            pos += 1
+        bb[pos] = len(self.returns)  # returns (varuint1)
+        pos += 1
         for rettype in self.returns:
-            f.write(LANG_TYPES[rettype])
+            bb[pos] = LANG_TYPES[rettype][0]
+            pos += 1
+        return pos
 
 
-class FunctionDef(WASMComponent):
+class FunctionDef(_Tracked, WASMComponent):
     """ The definition (of the body) of a function. The instructions can be
     Instruction instances or strings/tuples describing the instruction.
+    Alternatively, a single InstructionBuffer can be given.
+    
+    Calls to functions by name are resolved when the module is linked. The
+    encoded body is cached until the function definition is modified.
     """
     
-    __slots__ = ['locals', 'instructions', 'module']
+    __slots__ = ['locals', 'instructions', '_cache', '_parent', '_linked', '_linked_version',
+                 '_body', '_digest']
     
     def __init__(self, locals, *instructions):
+        self._cache = None
+        self._parent = None
+        self._linked = None
+        self._body = None
+        self._digest = None
         for loc in locals:
             assert isinstance(loc, str)  # valuetype
-        self.locals = locals
-        self.instructions = []
+        self.locals = list(locals)
+        if len(instructions) == 1 and isinstance(instructions[0], InstructionBuffer):
+            self.instructions = instructions[0]
+            return
+        instructions2 = []
         for instruction in instructions:
             if isinstance(instruction, str):
-                instruction = Instruction(instruction)
+                instruction = _INTERNED_INSTRUCTIONS.get(instruction) or Instruction(instruction)
             elif isinstance(instruction, tuple):
                 instruction = Instruction(*instruction)
             assert isinstance(instruction, Instruction)
-            self.instructions.append(instruction)
-        self.module = None
-    
-    def to_text(self):
-        s = 'FunctionDef(' + str(list(self.locals)) + '\n'
-        s += self._get_sub_text(self.instructions, True)
-        s += '\n)'
-        return s
+            instructions2.append(instruction)
+        self.instructions = instructions2
+    
+    def __setattr__(self, name, value):
+        if name in ('locals', 'instructions') and getattr(self, '_body', None) is not None:
+            self._decode_body()  # so that the other one is not decoded later
+        super().__setattr__(name, value)
+        if name == 'instructions' and isinstance(value, InstructionBuffer):
+            value._callback = self.invalidate
+    
+    def __getstate__(self):
+        # Pickle just the function itself, e.g. to encode it in another process
+        return self.locals, self.instructions
+    
+    def __setstate__(self, state):
+        self._cache = None
+        self._parent = None
+        self._linked = None
+        self._body = None
+        self._digest = None
+        self.locals, self.instructions = state
+    
+    @classmethod
+    def _read(cls, bb, pos, lazy=False):
+        # Read a function body. Returns (functiondef, new_position). The
+        # function definition keeps the original bytes as its cache. If lazy,
+        # the locals and instructions are decoded on first access.
+        start = pos
+        size, pos = read_uleb(bb, pos)
+        end = pos + size
+        if end > len(bb):
+            raise ValueError('Function body at %i extends beyond the end of the data.' % start)
+        if lazy:
+            functiondef = cls.__new__(cls)
+            functiondef._parent = None
+            functiondef._digest = None
+            functiondef._body = bb[start:end]
+        else:
+            locals, instructions = _read_function_body(bb, start)
+            functiondef = cls(locals, *instructions)
+        functiondef._cache = bb[start:end]
+        functiondef._linked = functiondef  # decoded bodies call by index
+        return functiondef, end
+    
+    def __getattr__(self, name):
+        # Only called for attributes that are not set. The locals and
+        # instructions of a lazily decoded function are decoded on first access.
+        if name in ('locals', 'instructions') and getattr(self, '_body', None) is not None:
+            self._decode_body()
+            return getattr(self, name)
+        raise AttributeError('%r object has no attribute %r' % (self.__class__.__name__, name))
+    
+    def _decode_body(self):
+        locals, instructions = _read_function_body(self._body, 0)
+        self._body = None
+        object.__setattr__(self, 'locals', _TrackedList(locals, self.invalidate))
+        object.__setattr__(self, 'instructions', _TrackedList(instructions, self.invalidate))
+    
+    def _write_text(self, f, indent):
+        self._write_sub_text(f, indent, 'FunctionDef(' + str(list(self.locals)), self.instructions)
+    
+    def sort_locals(self, num_params):
+        """ Reorder the locals by type, so that each type needs only a single
+        local declaration. The indices of get_local, set_local and tee_local
+        instructions are remapped accordingly. The parameters of the function
+        (the first num_params local indices) keep their place; a function
+        definition does not know its signature, so num_params must be given.
+        """
+        types = []
+        for loc_type in self.locals:
+            if loc_type not in types:
+                types.append(loc_type)
+        order = sorted(range(len(self.locals)), key=lambda i: types.index(self.locals[i]))
+        if order == list(range(len(self.locals))):
+            return  # already sorted
+        remap = {}  # old index -> new index
+        for new_index, old_index in enumerate(order):
+            remap[num_params + old_index] = num_params + new_index
+        locals = [self.locals[i] for i in order]
+        if isinstance(self.instructions, InstructionBuffer):
+            instructions = self.instructions._remap_locals(remap)
+        else:
+            instructions = [instruction._remap_locals(remap)
+                            for instruction in self.instructions]
+        self.locals = locals
+        self.instructions = instructions
     
-    def to_file(self, f):
-        
+    def invalidate(self):
+        self._cache = None
+        self._linked = None
+        self._digest = None
+        super().invalidate()
+    
+    def digest(self):
+        """ Get a structural hash of the function definition (32 bytes),
+        computed from its encoded locals, opcodes and immediates. Calls by
+        name are hashed by name, so the result does not depend on the module
+        that the function is in. The result is cached until the function
+        definition is modified.
+        """
+        if self._digest is None:
+            if self._linked is self or not self._uses_func_names():
+                # Hash the encoded body, which decoded function definitions already have
+                if self._cache is None:
+                    self._cache = self._encode()
+                h = blake2b(self._cache, digest_size=32)
+            else:
+                # Encode with a placeholder index, and hash the names separately
+                names = []
+                if isinstance(self.instructions, InstructionBuffer):
+                    instructions = [self.instructions._resolve(_DIGEST_INDICES, names)]
+                else:
+                    instructions = [instruction._resolve(_DIGEST_INDICES, names)
+                                    for instruction in self.instructions]
+                placeholder = FunctionDef(self.locals, *instructions)
+                h = blake2b(placeholder._encode(), digest_size=32)
+                for name in names:
+                    h.update(packstr(name))
+            self._digest = h.digest()
+        return self._digest
+    
+    def _uses_func_names(self):
+        # Whether the body calls functions by name
+        if isinstance(self.instructions, InstructionBuffer):
+            return bool(self.instructions._calls)
+        todo = list(self.instructions)
+        while todo:
+            instruction = todo.pop()
+            if instruction.type == 'call' and isinstance(instruction.args[0], str):
+                return True
+            todo.extend(instruction.instructions)
+        return False
+    
+    def _link(self, func_id_to_index, version, unresolved, index):
+        # Resolve calls by name. Produces a copy of this function definition,
+        # or the function definition itself if it does not call by name.
+        if self._linked is self:
+            return  # does not depend on the function index space
+        elif self._linked is not None and self._linked_version == version:
+            return  # still up-to-date
+        elif not self._uses_func_names():
+            self._linked = self
+            return
+        resolved = []
+        if isinstance(self.instructions, InstructionBuffer):
+            instructions = [self.instructions._resolve(func_id_to_index, resolved)]
+        else:
+            instructions = [instruction._resolve(func_id_to_index, resolved)
+                            for instruction in self.instructions]
+        missing = [name for name in resolved if name not in func_id_to_index]
+        if missing:
+            unresolved.extend((index, name) for name in missing)
+            self._linked = None
+        else:
+            self._linked = FunctionDef(self.locals, *instructions)
+            self._linked_version = version
+    
+    def _get_linked(self):
+        # Get the function definition with calls resolved
+        if self._linked is None:
+            if self._uses_func_names():
+                raise ValueError('Cannot encode a call by name before the module is linked.')
+            self._linked = self
+        return self._linked
+    
+    def _get_size(self):
+        if self._cache is None:
+            self._cache = self._encode()
+        return len(self._cache)
+    
+    def _write_into(self, bb, pos):
+        return write_bytes(bb, pos, self._cache)  # set in _get_size()
+    
+    def _get_size_without_caching(self):
+        if self._cache is not None:
+            return len(self._cache)
+        size = self._get_body_size(self._get_local_entries())
+        return uleb_size(size) + size
+    
+    def _write_to_file(self, f):
+        f.write(self._encode() if self._cache is None else self._cache)
+    
+    def _get_local_entries(self):
         # Collect locals by type
         local_entries = []  # list of (count, type) tuples
         for loc_type in self.locals:
-            if local_entries and local_entries[-1] == loc_type:
+            if local_entries and local_entries[-1][1] == loc_type:
                 local_entries[-1] = local_entries[-1][0] + 1, loc_type
             else:
                 local_entries.append((1, loc_type))
+        return local_entries
+    
+    def _get_body_size(self, local_entries):
+        size = uleb_size(len(local_entries))
+        for localentry in local_entries:
+            size += uleb_size(localentry[0]) + 1
+        if isinstance(self.instructions, InstructionBuffer):
+            size += self.instructions._get_size()
+        else:
+            for instruction in self.instructions:
+                size += instruction._get_size()
+        size += 1  # end
+        return size
+    
+    def _encode(self):
+        if self._linked is not self and self._uses_func_names():
+            raise ValueError('Cannot encode a call by name before the module is linked.')
+        local_entries = self._get_local_entries()
+        size = self._get_body_size(local_entries)
         
-        f3 = BytesIO()
-        f3.write(packvu32(len(local_entries)))  # number of local-entries in this func
+        # Write the body, prefixed with its size
+        bb = bytearray(uleb_size(size) + size)
+        pos = write_uleb(bb, 0, size)  # number of bytes in body
+        pos = write_uleb(bb, pos, len(local_entries))  # number of local-entries in this func
         for localentry in local_entries:
-            f3.write(packvu32(localentry[0]))  # number of locals of this type
-            f3.write(LANG_TYPES[localentry[1]])
-        for instruction in self.instructions:
-            instruction.to_file(f3, self.module)
-        f3.write(b'\x0b')  # end
-        body = f3.getvalue()
-        f.write(packvu32(len(body)))  # number of bytes in body
-        f.write(body)
+            pos = write_uleb(bb, pos, localentry[0])  # number of locals of this type
+            bb[pos] = LANG_TYPES[localentry[1]][0]
+            pos += 1
+        if isinstance(self.instructions, InstructionBuffer):
+            pos = self.instructions._write_into(bb, pos)
+        else:
+            for instruction in self.instructions:
+                pos = instruction._write_into(bb, pos)
+        bb[pos] = 0x0b  # end
+        assert pos + 1 == len(bb)
+        return bb
+
+
+class _DigestIndices:
+    """ Maps every function name to a placeholder index that cannot occur
+    in a valid module. Used to resolve calls by name when hashing.
+    """
+    
+    def get(self, name, default=None):
+        return 2 ** 32
+
+_DIGEST_INDICES = _DigestIndices()
 
 
 class Instruction(WASMComponent):
     """ Class ro represent an instruction. Can have nested instructions, which
     really just come after it (so it only allows semantic sugar for blocks and loops.
+    
+    Instructions are immutable; their immediates and nested instructions are
+    stored as tuples. Instructions without immediates are interned, so that
+    e.g. ``Instruction('f64.add')`` always produces the same object.
     """
     
     __slots__ = ['type', 'instructions', 'args']
     
-    def __init__(self, type, *args):
-        self.type = type.lower()
-        self.args = []
-        self.instructions = []
+    __init__ = object.__init__  # all is done in __new__
+    
+    def __new__(cls, type, *args):
+        if not args:
+            try:
+                return _INTERNED_INSTRUCTIONS[type]
+            except KeyError:
+                pass
+        type = type.lower()
+        immediates = []
+        instructions = []
         for arg in args:
             if isinstance(arg, WASMComponent):
                 assert isinstance(arg, Instruction)
-                self.instructions.append(arg)
+                instructions.append(arg)
+            elif isinstance(arg, list):
+                immediates.append(tuple(arg))  # br_table targets
             else:
-                self.args.append(arg)
+                immediates.append(arg)
+        # Validate up front, so that encoding does not have to
+        try:
+            nargs = _OPCODE_ENCODERS[type][1]
+        except KeyError:
+            raise TypeError('Unknown instruction %r' % type) from None
+        if len(immediates) != nargs:
+            raise TypeError('Instruction %r expects %i immediates, got %i' %
+                            (type, nargs, len(immediates)))
+        if not args and type in _INTERNED_INSTRUCTIONS:
+            return _INTERNED_INSTRUCTIONS[type]
+        self = object.__new__(cls)
+        _set_instruction_type(self, type)
+        _set_instruction_args(self, tuple(immediates))
+        _set_instruction_instructions(self, tuple(instructions))
+        return self
+    
+    def __setattr__(self, name, value):
+        raise AttributeError('Instruction objects are immutable.')
+    
+    def __delattr__(self, name):
+        raise AttributeError('Instruction objects are immutable.')
+    
+    def __reduce__(self):
+        # Pickle via the constructor, so that interned instructions stay interned
+        return Instruction, (self.type, ) + self.args + self.instructions
     
     def __repr__(self):
         return '<Instruction %s>' % self.type
@@ -710,43 +2281,614 @@ class Instruction(WASMComponent):
         else:
             return 'Instruction(' + repr(self.type) + ', ' + subtext + ')'
     
-    def to_file(self, f, m):
-        if self.type not in OPCODES:
-            raise TypeError('Unknown instruction %r' % self.type)
+    def _remap_locals(self, remap):
+        # Get this instruction with local indices remapped. Returns self if
+        # nothing changed.
+        instruction = self
+        if self.type in _LOCAL_INSTRUCTIONS and self.args[0] in remap:
+            instruction = Instruction(self.type, remap[self.args[0]])
+        if self.instructions:
+            nested = [sub._remap_locals(remap) for sub in self.instructions]
+            if instruction is not self or any(a is not b for a, b in zip(nested, self.instructions)):
+                instruction = Instruction(instruction.type, *instruction.args, *nested)
+        return instruction
+    
+    def _resolve(self, func_id_to_index, names):
+        # Get this instruction with calls by name resolved. Returns self if
+        # there is nothing to resolve. Used names are added to the given list.
+        instruction = self
+        if self.type == 'call' and isinstance(self.args[0], str):
+            names.append(self.args[0])
+            instruction = Instruction('call', func_id_to_index.get(self.args[0], 0))
+        if self.instructions:
+            nested = [sub._resolve(func_id_to_index, names) for sub in self.instructions]
+            if instruction is not self or any(a is not b for a, b in zip(nested, self.instructions)):
+                instruction = Instruction(instruction.type, *instruction.args, *nested)
+        return instruction
+    
+    def _get_size(self):
+        opcode, nargs, encoders = _OPCODE_ENCODERS[self.type]
+        size = 1  # Our instruction
         
-        # Our instruction
-        f.write(bytes([OPCODES[self.type]]))
+        # Data comes after
+        if encoders:
+            args = self.args
+            for i, get_size, write in encoders:
+                size += get_size(args, i)
+        
+        # Nested instructions
+        for instruction in self.instructions:
+            size += instruction._get_size()
+        return size
+    
+    def _write_into(self, bb, pos):
+        opcode, nargs, encoders = _OPCODE_ENCODERS[self.type]
         
-        # Prep args
-        args = self.args
-        if self.type == 'call':
-            if isinstance(args[0], str):
-                args = [m.func_id_to_index[args[0]]]
+        # Our instruction
+        bb[pos] = opcode
+        pos += 1
         
         # Data comes after
-        for arg in args:
-            if isinstance(arg, (float, int)):
-                if self.type.startswith('f64.'):
-                    f.write(packf64(arg))
-                elif self.type.startswith('i64.'):
-                    f.write(packvs64(arg))
-                elif self.type.startswith('i32.'):
-                    f.write(packvs32(arg))
-                elif self.type.startswith('i') or self.type.startswith('f'):
-                    raise RuntimeError('Unsupported instruction arg for %s' % self.type)
-                else:
-                    f.write(packvu32(arg))
-            elif isinstance(arg, str):
-                f.write(LANG_TYPES[arg])
-            else:
-                raise TypeError('Unknown instruction arg %r' % arg)  # todo: e.g. constants
+        if encoders:
+            args = self.args
+            for i, get_size, write in encoders:
+                pos = write(bb, pos, args, i)
         
         # Nested instructions
         for instruction in self.instructions:
-            instruction.to_file(f, m)
+            pos = instruction._write_into(bb, pos)
+        return pos
+
+
+_set_instruction_type = Instruction.type.__set__
+_set_instruction_args = Instruction.args.__set__
+_set_instruction_instructions = Instruction.instructions.__set__
+
+# The shared instances of instructions without immediates (filled in two
+# steps, because the constructor looks in this dict)
+_INTERNED_INSTRUCTIONS = {}
+_INTERNED_INSTRUCTIONS.update((name, Instruction(name)) for name, encoder in _OPCODE_ENCODERS.items()
+                              if encoder[1] == 0)
+
+
+class InstructionBuffer(WASMComponent):
+    """ A compact sequence of instructions, as an alternative to a list of
+    Instruction objects. Instructions are encoded as they are appended, and
+    stored in a flat bytearray (plus an array of instruction offsets), so
+    that no per-instruction objects are needed. Calls to functions by name
+    are resolved when the module that uses the buffer is linked.
+    
+    Iterating over the buffer produces Instruction objects.
+    """
+    
+    __slots__ = ['_code', '_offsets', '_calls', '_callback']
+    
+    def __init__(self, *instructions):
+        self._callback = None  # set by the FunctionDef that uses this buffer
+        self._code = bytearray()
+        self._offsets = array('I')
+        self._calls = {}  # offset of call target -> function name
+        self.extend(instructions)
+    
+    def __len__(self):
+        return len(self._offsets)
+    
+    def __getstate__(self):
+        return self._code, self._offsets, self._calls
+    
+    def __setstate__(self, state):
+        self._code, self._offsets, self._calls = state
+        self._callback = None
+    
+    def __iter__(self):
+        code = self._code
+        calls = self._calls
+        for offset in self._offsets:
+            if offset + 1 in calls:
+                yield Instruction('call', calls[offset + 1])
+            else:
+                type, args, pos = read_instruction(code, offset)
+                yield Instruction(type, *args)
+    
+    def to_text(self):
+        return 'InstructionBuffer(<%i instructions>)' % len(self)
+    
+    def append(self, type, *args):
+        """ Append an instruction, given by its opcode name (e.g. 'f64.add'
+        or `I.f64.add`) and its immediates.
+        """
+        try:
+            opcode, nargs, encoders = _OPCODE_ENCODERS[type]
+        except KeyError:
+            raise TypeError('Unknown instruction %r' % type) from None
+        if len(args) != nargs:
+            raise TypeError('Instruction %r expects %i immediates, got %i' %
+                            (type, nargs, len(args)))
+        if self._callback is not None:
+            self._callback()
+        code = self._code
+        pos = len(code)
+        self._offsets.append(pos)
+        code.append(opcode)
+        if encoders:
+            if type == 'call' and isinstance(args[0], str):
+                self._calls[pos + 1] = args[0]  # resolved when linking
+                return
+            size = 0
+            for i, get_size, write in encoders:
+                size += get_size(args, i)
+            code += bytes(size)
+            pos += 1
+            for i, get_size, write in encoders:
+                pos = write(code, pos, args, i)
+    
+    def extend(self, instructions):
+        """ Append multiple instructions, given as Instruction objects or
+        strings/tuples describing the instruction.
+        """
+        append = self.append
+        for instruction in instructions:
+            if isinstance(instruction, str):
+                append(instruction)
+            elif isinstance(instruction, tuple):
+                if any(isinstance(arg, Instruction) for arg in instruction):
+                    self.extend([Instruction(*instruction)])
+                else:
+                    append(*instruction)
+            elif isinstance(instruction, Instruction):
+                append(instruction.type, *instruction.args)
+                self.extend(instruction.instructions)
+            else:
+                raise TypeError('InstructionBuffer cannot append %r' % instruction)
+    
+    def _remap_locals(self, remap):
+        # Get a copy of this buffer with local indices remapped
+        new = InstructionBuffer()
+        append = new.append
+        for instruction in self:
+            if instruction.type in _LOCAL_INSTRUCTIONS:
+                append(instruction.type, remap.get(instruction.args[0], instruction.args[0]))
+            else:
+                append(instruction.type, *instruction.args)
+        return new
+    
+    def _resolve(self, func_id_to_index, names):
+        # Get a copy of this buffer with calls by name resolved. Returns self
+        # if there is nothing to resolve. Used names are added to the given list.
+        if not self._calls:
+            return self
+        code = self._code
+        new = InstructionBuffer()
+        new_code = new._code
+        # Copy chunks of code, with call targets in between
+        shift = 0  # how much later instructions move
+        calls = list(self._calls.items())
+        ci = 0
+        with memoryview(code) as view:
+            i = 0
+            for offset, name in calls:
+                names.append(name)
+                new_code += view[i:offset]
+                write_index = len(new_code)
+                new_code += bytes(uleb_size(func_id_to_index.get(name, 0)))
+                write_uleb(new_code, write_index, func_id_to_index.get(name, 0))
+                i = offset
+            new_code += view[i:]
+        # Shift the instruction offsets
+        for offset in self._offsets:
+            while ci < len(calls) and calls[ci][0] <= offset:
+                shift += uleb_size(func_id_to_index.get(calls[ci][1], 0))
+                ci += 1
+            new._offsets.append(offset + shift)
+        return new
+    
+    def _get_size(self):
+        assert not self._calls, 'Cannot encode a call by name before the module is linked.'
+        return len(self._code)
+    
+    def _write_into(self, bb, pos):
+        return write_bytes(bb, pos, self._code)
+
+
+# Map instructions that access memory to the size of the access (in bytes)
+_MEMORY_ACCESS_SIZES = {}
+for _name, _opcode, _immediates in OPCODE_TABLE:
+    if _immediates == ('memarg', ):
+        _op = _name.split('.')[1]
+        _bits = (_op[4:] if _op.startswith('load') else _op[5:]).split('_')[0] or _name[1:3]
+        _MEMORY_ACCESS_SIZES[_name] = int(_bits) // 8
+
+
+def _iter_flat(instructions):
+    # Iterate over the instructions in the order that they are encoded
+    for instruction in instructions:
+        yield instruction
+        if instruction.instructions:
+            yield from _iter_flat(instruction.instructions)
+
+
+def _validate_functiondef(funcdef, sig, func_sigs, functionsigs, func_id_to_index,
+                          has_memory, errors, func_index):
+    # Type-check the body of a function definition in a single pass, using the
+    # stack effects of the instructions. Errors are added to the given list.
+    # Returns the maximum stack depth. Unknown types (on the unreachable part
+    # of the stack, and of globals) are represented with None.
+    locals = list(sig.params) + list(funcdef.locals)
+    returns = tuple(sig.returns)
+    stack = []
+    # Control frames: [kind, label types, result types, stack height, unreachable]
+    frames = [['function', returns, returns, 0, False]]
+    max_depth = 0
+    position = [0, 'start']
+    
+    def error(msg):
+        errors.append('function %i, instruction %i (%s): %s' %
+                      (func_index, position[0], position[1], msg))
+    
+    def pop(expected=None):
+        frame = frames[-1]
+        if len(stack) == frame[3]:
+            if not frame[4]:
+                error('expected %s on the stack, but it is empty' % (expected or 'a value'))
+            return expected
+        value_type = stack.pop()
+        if expected is not None and value_type is not None and value_type != expected:
+            error('expected %s on the stack, got %s' % (expected, value_type))
+        return value_type or expected
+    
+    def pop_types(types):
+        for value_type in reversed(types):
+            pop(value_type)
+    
+    def set_unreachable():
+        frame = frames[-1]
+        del stack[frame[3]:]
+        frame[4] = True
+    
+    def end_frame(frame):
+        pop_types(frame[2])
+        if len(stack) > frame[3]:
+            error('%i value(s) left on the stack at the end of the %s' %
+                  (len(stack) - frame[3], frame[0]))
+            del stack[frame[3]:]
+    
+    def get_label(depth):
+        if depth >= len(frames):
+            error('branch depth %i out of range' % depth)
+            return None
+        return frames[-1 - depth][1]
+    
+    for i, instruction in enumerate(_iter_flat(funcdef.instructions)):
+        type = instruction.type
+        args = instruction.args
+        position[0], position[1] = i, type
+        effect = STACK_EFFECTS[type]
+        if effect is not None:
+            if type in _MEMORY_ACCESS_SIZES or type.endswith('_memory'):
+                if not has_memory:
+                    error('no memory defined')
+                if type in _MEMORY_ACCESS_SIZES and 2 ** args[0] > _MEMORY_ACCESS_SIZES[type]:
+                    error('alignment 2**%i is larger than natural alignment' % args[0])
+            pop_types(effect[0])
+            stack.extend(effect[1])
+        elif type in ('block', 'loop', 'if'):
+            results = () if args[0] == 'emptyblock' else (args[0], )
+            if type == 'if':
+                pop('i32')
+            frames.append([type, () if type == 'loop' else results, results, len(stack), False])
+        elif type == 'else':
+            frame = frames[-1]
+            if frame[0] != 'if':
+                error('else without matching if')
+            else:
+                end_frame(frame)
+                frame[0], frame[4] = 'else', False
+        elif type == 'end':
+            if len(frames) == 1:
+                error('end without matching block')
+            else:
+                frame = frames[-1]
+                end_frame(frame)
+                if frame[0] == 'if' and frame[2]:
+                    error('if without else cannot have a result')
+                frames.pop()
+                stack.extend(frame[2])
+        elif type == 'br':
+            label = get_label(args[0])
+            if label is not None:
+                pop_types(label)
+            set_unreachable()
+        elif type == 'br_if':
+            pop('i32')
+            label = get_label(args[0])
+            if label is not None:
+                pop_types(label)
+                stack.extend(label)
+        elif type == 'br_table':
+            pop('i32')
+            label = get_label(args[1])
+            for depth in args[0]:
+                other = get_label(depth)
+                if label is not None and other is not None and other != label:
+                    error('branch targets have different types')
+            if label is not None:
+                pop_types(label)
+            set_unreachable()
+        elif type == 'return':
+            pop_types(returns)
+            set_unreachable()
+        elif type == 'unreachable':
+            set_unreachable()
+        elif type in ('call', 'call_indirect'):
+            callee = None
+            if type == 'call_indirect':
+                pop('i32')
+                if args[0] < len(functionsigs):
+                    callee = functionsigs[args[0]]
+                else:
+                    error('signature index %i out of range' % args[0])
+            else:
+                index = func_id_to_index.get(args[0]) if isinstance(args[0], str) else args[0]
+                if index is None:
+                    error('unknown function %r' % args[0])
+                elif index >= len(func_sigs):
+                    error('function index %i out of range' % index)
+                else:
+                    callee = func_sigs[index]
+            if callee is not None:
+                pop_types(callee.params)
+                stack.extend(callee.returns)
+        elif type == 'drop':
+            pop()
+        elif type == 'select':
+            pop('i32')
+            value_type = pop()
+            stack.append(pop(value_type))
+        elif type in _LOCAL_INSTRUCTIONS:
+            if args[0] >= len(locals):
+                error('local index %i out of range' % args[0])
+                value_type = None
+            else:
+                value_type = locals[args[0]]
+            if type != 'get_local':
+                pop(value_type)
+            if type != 'set_local':
+                stack.append(value_type)
+        elif type == 'get_global':
+            stack.append(None)  # globals are not supported yet
+        elif type == 'set_global':
+            pop()
+        max_depth = max(max_depth, len(stack))
+    
+    # The final end
+    position[0], position[1] = i + 1 if funcdef.instructions else 0, 'end'
+    if len(frames) > 1:
+        error('%i block(s) not closed' % (len(frames) - 1))
+    else:
+        end_frame(frames[0])
+    return max_depth
+
+
+def _get_wat_id(name):
+    # Get a name as identifier in the text format
+    name = name if name.startswith('$') else '$' + name
+    return name + ' '
+
+
+# Escaped bytes for data in strings in the text format
+_WAT_ESCAPED_BYTES = ['\\%02x' % i for i in range(256)]
+
+
+def _get_wat_string(text):
+    # Get a string in the text format
+    chars = []
+    for c in text.encode('utf-8'):
+        if 0x20 <= c < 0x7f and c not in b'"\\':
+            chars.append(chr(c))
+        else:
+            chars.append('\\%02x' % c)
+    return '"' + ''.join(chars) + '"'
+
+
+def _get_wat_signature(functionsig):
+    s = ''
+    if functionsig.params:
+        s += ' (param %s)' % ' '.join(functionsig.params)
+    if functionsig.returns:
+        s += ' (result %s)' % ' '.join(functionsig.returns)
+    return s
+
+
+def _get_wat_float(value, bits):
+    # NaNs with a payload other than the canonical one are written as
+    # nan:0x..., with the payload as it is encoded
+    if value != value:
+        sign = '' if copysign(1.0, value) > 0 else '-'
+        if bits == 32:
+            payload = unpack_from('<I', spack('<f', value))[0] & 0x7fffff
+            canonical = 0x400000
+        else:
+            payload = unpack_from('<Q', spack('<d', value))[0] & 0xfffffffffffff
+            canonical = 0x8000000000000
+        if payload == canonical:
+            return sign + 'nan'
+        return sign + 'nan:0x%x' % payload
+    elif value in (inf, -inf):
+        return 'inf' if value > 0 else '-inf'
+    return repr(value)
+
+
+def _get_wat_instruction(instruction, names):
+    # Get the text of an instruction in the text format
+    type = instruction.type
+    args = instruction.args
+    name = WAT_NAMES[type]
+    if not args:
+        return name
+    elif type in ('block', 'loop', 'if'):
+        return name if args[0] == 'emptyblock' else '%s (result %s)' % (name, args[0])
+    elif type == 'br_table':
+        return name + ' ' + ' '.join(str(i) for i in list(args[0]) + [args[1]])
+    elif type == 'call':
+        if isinstance(args[0], str):
+            return name + ' ' + _get_wat_id(args[0]).rstrip()
+        return name + ' ' + names.get(args[0], '%i ' % args[0]).rstrip()
+    elif type == 'call_indirect':
+        return '%s (type %i)' % (name, args[0])
+    elif type in _MEMORY_ACCESS_SIZES:
+        s = name
+        if args[1]:
+            s += ' offset=%i' % args[1]
+        if 2 ** args[0] != _MEMORY_ACCESS_SIZES[type]:
+            s += ' align=%i' % 2 ** args[0]
+        return s
+    elif type in ('f32.const', 'f64.const'):
+        return name + ' ' + _get_wat_float(args[0], 32 if type == 'f32.const' else 64)
+    return name + ' ' + ' '.join(str(arg) for arg in args)
+
+
+def _write_wat_instructions(f, instructions, names):
+    # Write the instructions of a function body in the text format, with
+    # the instructions inside blocks indented.
+    indent = '    '
+    for instruction in _iter_flat(instructions):
+        type = instruction.type
+        if type in ('end', 'else') and len(indent) > 4:
+            indent = indent[:-2]
+        f.write(indent + _get_wat_instruction(instruction, names) + '\n')
+        if type in ('block', 'loop', 'if', 'else'):
+            indent += '  '
+
+
+class ModuleDecoder:
+    """ Push-based decoder for a binary WASM module that arrives in chunks,
+    e.g. from a pipe or socket. Each call to feed() returns the sections
+    that were completed by the given chunk, so that these can be processed
+    before the rest of the module arrives. The function definitions in the
+    code section are returned one by one as soon as each is complete,
+    followed by the CodeSection itself when all have arrived.
+    
+    Only the section (or for the code section, the function body) that is
+    being received is buffered. Call close() at the end of the input to
+    check that the module is complete. See Module.from_bytes() for the
+    lazy argument.
+    """
+    
+    __slots__ = ['lazy', '_buffer', '_has_header', '_functiondefs', '_code_count', '_code_left']
+    
+    def __init__(self, lazy=False):
+        self.lazy = lazy
+        self._buffer = bytearray()
+        self._has_header = False
+        self._functiondefs = None  # list while in the code section
+        self._code_count = 0  # number of function bodies in the code section
+        self._code_left = 0  # number of bytes left in the code section
+    
+    def feed(self, chunk):
+        """ Add bytes to the decoder. Returns a list of the Section and
+        FunctionDef objects that are completed by these bytes.
+        """
+        buffer = self._buffer
+        buffer += chunk
+        items = []
+        pos = 0
+        try:
+            while True:
+                new_pos = self._read_item(pos, items)
+                if new_pos is None:
+                    break  # wait for more data
+                pos = new_pos
+        finally:
+            del buffer[:pos]
+        return items
+    
+    def close(self):
+        """ Signal the end of the input. Raises ValueError if the module
+        is incomplete.
+        """
+        if not self._has_header or self._buffer or self._functiondefs is not None:
+            raise ValueError('Unexpected end of WASM data.')
+    
+    def _read_uleb(self, pos):
+        # Read an unsigned LEB128 value. Returns (None, pos) if incomplete.
+        try:
+            return read_uleb(self._buffer, pos)
+        except IndexError:
+            return None, pos
+    
+    def _read_item(self, pos, items):
+        # Read the header, a section, or a function body at the given
+        # position. Returns the new position, or None if incomplete.
+        buffer = self._buffer
+        if not self._has_header:
+            if len(buffer) < pos + 8:
+                return None
+            if bytes(buffer[pos:pos + 8]) != b'\x00asm' + packu32(1):
+                raise ValueError('Data is not a WASM module (version 1).')
+            self._has_header = True
+            return pos + 8
+        
+        if self._functiondefs is not None:
+            # In the code section
+            functiondefs = self._functiondefs
+            if len(functiondefs) == self._code_count:
+                if self._code_left != 0:
+                    raise ValueError('Code section has %i bytes left.' % self._code_left)
+                section = CodeSection(*functiondefs)
+                for functiondef in functiondefs:
+                    functiondef._parent = section
+                items.append(section)
+                self._functiondefs = None
+                return pos
+            size, body_pos = self._read_uleb(pos)
+            if size is None or len(buffer) < body_pos + size:
+                return None
+            end = body_pos + size
+            self._code_left -= end - pos
+            if self._code_left < 0:
+                raise ValueError('Function body extends beyond the code section.')
+            functiondef, _ = FunctionDef._read(memoryview(buffer[pos:end]), 0, self.lazy)
+            functiondefs.append(functiondef)
+            items.append(functiondef)
+            return end
+        
+        if len(buffer) <= pos:
+            return None
+        size, payload_pos = self._read_uleb(pos + 1)
+        if size is None:
+            return None
+        if buffer[pos] == CodeSection.id:
+            # Read the function bodies one by one
+            count, body_pos = self._read_uleb(payload_pos)
+            if count is None:
+                return None
+            self._functiondefs = []
+            self._code_count = count
+            self._code_left = size - (body_pos - payload_pos)
+            return body_pos
+        end = payload_pos + size
+        if len(buffer) < end:
+            return None
+        try:
+            section, _ = _read_section(memoryview(buffer[pos:end]), 0, self.lazy)
+        except IndexError:
+            raise ValueError('Unexpected end of section data.') from None
+        items.append(section)
+        return end
+
+
+_parallel_funcdefs = None  # inherited by forked worker processes
+
+
+def _encode_functiondefs(funcdefs):
+    # Encode (linked) function bodies, run in a worker process by Module.to_bytes().
+    # The funcdefs are given directly, or as a range into _parallel_funcdefs.
+    if isinstance(funcdefs, range):
+        funcdefs = [_parallel_funcdefs[i] for i in funcdefs]
+    return [funcdef._encode() for funcdef in funcdefs]
 
 
 # Collect field classes
-_exportable_classes = WASMComponent, Function, ImportedFuncion
+_exportable_classes = WASMComponent, Function, ImportedFuncion, ModuleBuilder, ModuleDecoder
 __all__ = [name for name in globals()
            if isinstance(globals()[name], type) and issubclass(globals()[name], _exportable_classes)]
@@ -0,0 +1,913 @@
+"""
+Optimization passes that rewrite the instructions of function definitions.
+
+Each pass is a function that takes a FunctionDef, the number of
+parameters of the function and its result types (None if not known),
+rewrites the function definition in-place, and returns whether anything
+changed. Nested instructions are flattened.
+Use `Module.optimize()` to apply passes to all functions of a module.
+"""
+
+import math
+from math import copysign, inf, nan
+from struct import pack, unpack
+
+from ._opcodes import OPCODES, STACK_EFFECTS
+from .components import Instruction, _iter_flat
+from .analysis import ControlFlowGraph, _iter_bits
+
+
+__all__ = ['PEEPHOLE_RULES', 'FOLDING_RULES', 'DEFAULT_PASSES', 'peephole', 'fold_constants',
+           'cleanup_control_flow', 'coalesce_locals']
+
+
+# Instructions without side effects that cannot trap; if the result is
+# not used, they can be removed (together with the code for their operands).
+PURE_INSTRUCTIONS = frozenset(
+    [name for name in OPCODES
+     if OPCODES[name] >= 0x45 and '.div_' not in name and '.rem_' not in name and '.trunc_' not in name] +
+    ['i32.const', 'i64.const', 'f32.const', 'f64.const', 'get_local', 'get_global', 'current_memory'])
+
+_PUSH_INSTRUCTIONS = ('i32.const', 'i64.const', 'f32.const', 'f64.const',
+                      'get_local', 'get_global', 'current_memory')
+_UNARY_INSTRUCTIONS = tuple(name for name in PURE_INSTRUCTIONS if STACK_EFFECTS[name] is not None and
+                            len(STACK_EFFECTS[name][0]) == 1)
+_BINARY_INSTRUCTIONS = tuple(name for name in PURE_INSTRUCTIONS if STACK_EFFECTS[name] is not None and
+                             len(STACK_EFFECTS[name][0]) == 2)
+
+
+## Peephole rules
+
+# A rule is a tuple (pattern, rewrite). The pattern is a tuple with an
+# element per instruction: an instruction type, or a tuple of instruction
+# types. The rewrite function gets the matched instructions and returns
+# a list of instructions to replace them with, or None if the rule does
+# not apply after all. Rewrites should not make the code longer, so that
+# rewriting ends.
+
+def _rewrite_set_get(set_, get):
+    # set_local x; get_local x -> tee_local x
+    if set_.args[0] == get.args[0]:
+        return [Instruction('tee_local', set_.args[0])]
+
+
+def _rewrite_tee_drop(tee, drop):
+    # tee_local x; drop -> set_local x
+    return [Instruction('set_local', tee.args[0])]
+
+
+def _rewrite_tee_set(tee, set_):
+    # tee_local x; set_local x -> set_local x
+    if tee.args[0] == set_.args[0]:
+        return [set_]
+
+
+def _rewrite_get_set(get, set_):
+    # get_local x; set_local x -> (nothing)
+    if get.args[0] == set_.args[0]:
+        return []
+
+
+def _rewrite_push_drop(push, drop):
+    # A value that is dropped right away does not have to be computed
+    return []
+
+
+def _rewrite_unary_drop(unary, drop):
+    return [drop]
+
+
+def _rewrite_binary_drop(binary, drop):
+    return [drop, drop]
+
+
+def _rewrite_nop(nop):
+    return []
+
+
+def _rewrite_double_neg(neg1, neg2):
+    # Negation only flips the sign bit, so this is exact (also for NaN)
+    return []
+
+
+def _rewrite_zero_sub(const, push, sub):
+    # -0.0 - x is the same as -x, also for zeros. This is not the case for
+    # +0.0, because 0.0 - 0.0 is +0.0.
+    if const.args[0] == 0 and copysign(1.0, const.args[0]) < 0:
+        return [push, Instruction(sub.type.split('.')[0] + '.neg')]
+
+
+def _rewrite_double_eqz(eqz1, eqz2, branch):
+    # A branch only checks whether the condition is nonzero
+    return [branch]
+
+
+def _rewrite_int_identity(const, op):
+    # x + 0, x - 0, x | 0, x ^ 0, x << 0, x >> 0 and x * 1 are x
+    if const.args[0] == (1 if op.type.endswith('.mul') else 0):
+        return []
+
+
+_IDENTITY_OPS = ('add', 'sub', 'or', 'xor', 'shl', 'shr_s', 'shr_u', 'rotl', 'rotr', 'mul')
+
+PEEPHOLE_RULES = [
+    (('set_local', 'get_local'), _rewrite_set_get),
+    (('tee_local', 'drop'), _rewrite_tee_drop),
+    (('tee_local', 'set_local'), _rewrite_tee_set),
+    (('get_local', 'set_local'), _rewrite_get_set),
+    (('nop', ), _rewrite_nop),
+    ((_PUSH_INSTRUCTIONS, 'drop'), _rewrite_push_drop),
+    ((_UNARY_INSTRUCTIONS, 'drop'), _rewrite_unary_drop),
+    ((_BINARY_INSTRUCTIONS, 'drop'), _rewrite_binary_drop),
+    (('f32.neg', 'f32.neg'), _rewrite_double_neg),
+    (('f64.neg', 'f64.neg'), _rewrite_double_neg),
+    (('f32.const', _PUSH_INSTRUCTIONS, 'f32.sub'), _rewrite_zero_sub),
+    (('f64.const', _PUSH_INSTRUCTIONS, 'f64.sub'), _rewrite_zero_sub),
+    (('i32.eqz', 'i32.eqz', ('br_if', 'if')), _rewrite_double_eqz),
+    (('i32.const', tuple('i32.' + op for op in _IDENTITY_OPS)), _rewrite_int_identity),
+    (('i64.const', tuple('i64.' + op for op in _IDENTITY_OPS)), _rewrite_int_identity),
+    ]
+
+
+def _get_rules_by_last_type(rules):
+    # Index the rules by the type (or types) of their last instruction
+    rules_by_type = {}
+    for rule in rules:
+        last = rule[0][-1]
+        for type in ((last, ) if isinstance(last, str) else last):
+            rules_by_type.setdefault(type, []).append(rule)
+    return rules_by_type
+
+
+def _matches(pattern, instructions):
+    for element, instruction in zip(pattern, instructions):
+        if instruction.type != element and (isinstance(element, str) or
+                                            instruction.type not in element):
+            return False
+    return True
+
+
+def peephole(functiondef, num_params=0, returns=None, rules=None):
+    """ Rewrite short sequences of instructions in the given function
+    definition into shorter or cheaper ones, using the given rules (by
+    default `PEEPHOLE_RULES`). The rewrites are exact, e.g. `f64.const 0;
+    x; f64.sub` is not turned into a negation, because it differs for
+    zero (only `f64.const -0.0` is). Code produced by a rewrite is matched
+    again. Returns whether the function definition was changed. The
+    num_params and returns arguments are not used, but accepted like in
+    the other passes.
+    """
+    rules_by_type = _get_rules_by_last_type(PEEPHOLE_RULES if rules is None else rules)
+    changed = False
+    result = []
+    todo = list(_iter_flat(functiondef.instructions))
+    todo.reverse()
+    while todo:
+        instruction = todo.pop()
+        result.append(instruction)
+        for pattern, rewrite in rules_by_type.get(instruction.type, ()):
+            n = len(pattern)
+            if len(result) >= n and _matches(pattern, result[-n:]):
+                replacement = rewrite(*result[-n:])
+                if replacement is not None:
+                    del result[-n:]
+                    todo.extend(reversed(replacement))
+                    changed = True
+                    break
+    if changed:
+        functiondef.instructions = result
+    return changed
+
+
+
+## Constant folding
+
+def _to_signed(value, bits):
+    # Wrap an integer to the signed range of the given number of bits
+    value &= (1 << bits) - 1
+    return value - (1 << bits) if value >> (bits - 1) else value
+
+
+def _round_f32(value):
+    # Round a float to single precision, like the encoder does
+    try:
+        return unpack('<f', pack('<f', value))[0]
+    except OverflowError:
+        return copysign(inf, value)  # rounds to infinity
+
+
+def _div_trunc(a, b):
+    # Integer division that rounds towards zero
+    q = abs(a) // abs(b)
+    return -q if (a < 0) != (b < 0) else q
+
+
+_INT_OPS = {
+    'add': lambda a, b, bits: a + b,
+    'sub': lambda a, b, bits: a - b,
+    'mul': lambda a, b, bits: a * b,
+    'and': lambda a, b, bits: a & b,
+    'or': lambda a, b, bits: a | b,
+    'xor': lambda a, b, bits: a ^ b,
+    'shl': lambda a, b, bits: a << (b % bits),
+    'shr_s': lambda a, b, bits: a >> (b % bits),
+    'shr_u': lambda a, b, bits: (a % (1 << bits)) >> (b % bits),
+    'rotl': lambda a, b, bits: _rotl(a % (1 << bits), b % bits, bits),
+    'rotr': lambda a, b, bits: _rotl(a % (1 << bits), -b % bits, bits),
+    # Division traps for a zero divisor, and signed division for overflow
+    'div_s': lambda a, b, bits: None if b == 0 or (b == -1 and a == -1 << (bits - 1)) else
+    _div_trunc(a, b),
+    'div_u': lambda a, b, bits: None if b == 0 else (a % (1 << bits)) // (b % (1 << bits)),
+    'rem_s': lambda a, b, bits: None if b == 0 else a - b * _div_trunc(a, b),
+    'rem_u': lambda a, b, bits: None if b == 0 else (a % (1 << bits)) % (b % (1 << bits)),
+    'eq': lambda a, b, bits: int(a == b),
+    'ne': lambda a, b, bits: int(a != b),
+    'lt_s': lambda a, b, bits: int(a < b),
+    'gt_s': lambda a, b, bits: int(a > b),
+    'le_s': lambda a, b, bits: int(a <= b),
+    'ge_s': lambda a, b, bits: int(a >= b),
+    'lt_u': lambda a, b, bits: int(a % (1 << bits) < b % (1 << bits)),
+    'gt_u': lambda a, b, bits: int(a % (1 << bits) > b % (1 << bits)),
+    'le_u': lambda a, b, bits: int(a % (1 << bits) <= b % (1 << bits)),
+    'ge_u': lambda a, b, bits: int(a % (1 << bits) >= b % (1 << bits)),
+    'eqz': lambda a, bits: int(a == 0),
+    'clz': lambda a, bits: bits - (a % (1 << bits)).bit_length(),
+    'ctz': lambda a, bits: bits if a == 0 else ((a & -a).bit_length() - 1),
+    'popcnt': lambda a, bits: bin(a % (1 << bits)).count('1'),
+    }
+
+
+def _rotl(a, n, bits):
+    return (a << n) | (a >> (bits - n))
+
+
+def _float_div(a, b):
+    if b == 0:
+        if a == 0:
+            return nan
+        return copysign(inf, copysign(1.0, a) * copysign(1.0, b))
+    return a / b
+
+
+def _float_round(func, a):
+    # Apply ceil, floor, trunc or round, keeping infinities and the sign of zero
+    if math.isinf(a):
+        return a
+    return copysign(float(func(a)), a)
+
+
+def _float_sqrt(a):
+    return math.sqrt(a) if a >= 0 else nan  # sqrt(-0.0) is -0.0
+
+
+def _float_min(a, b):
+    if a == b == 0:
+        return a if copysign(1.0, a) < 0 else b  # -0.0 is less than +0.0
+    return min(a, b)
+
+
+def _float_max(a, b):
+    if a == b == 0:
+        return a if copysign(1.0, a) > 0 else b
+    return max(a, b)
+
+
+_FLOAT_OPS = {
+    'add': lambda a, b: a + b,
+    'sub': lambda a, b: a - b,
+    'mul': lambda a, b: a * b,
+    'div': _float_div,
+    'min': _float_min,
+    'max': _float_max,
+    'copysign': copysign,
+    'eq': lambda a, b: int(a == b),
+    'ne': lambda a, b: int(a != b),
+    'lt': lambda a, b: int(a < b),
+    'gt': lambda a, b: int(a > b),
+    'le': lambda a, b: int(a <= b),
+    'ge': lambda a, b: int(a >= b),
+    'abs': abs,
+    'neg': lambda a: -a,
+    'ceil': lambda a: _float_round(math.ceil, a),
+    'floor': lambda a: _float_round(math.floor, a),
+    'trunc': lambda a: _float_round(math.trunc, a),
+    'nearest': lambda a: _float_round(round, a),  # round half to even
+    'sqrt': _float_sqrt,
+    }
+
+
+def _convert(op, a):
+    # Evaluate a conversion. Returns None if it traps or cannot be evaluated exactly.
+    result_type, name = op.split('.')
+    bits = int(result_type[1:])
+    if '.trunc_' in op:
+        if math.isnan(a) or math.isinf(a):
+            return None  # traps
+        value = math.trunc(a)
+        low, high = (0, 1 << bits) if '_u_' in op else (-1 << (bits - 1), 1 << (bits - 1))
+        return _to_signed(value, bits) if low <= value < high else None
+    elif name == 'wrap_i64':
+        return _to_signed(a, 32)
+    elif name == 'extend_s_i32':
+        return a
+    elif name == 'extend_u_i32':
+        return a % (1 << 32)
+    elif name.startswith('convert_'):
+        if name.startswith('convert_u'):
+            a %= 1 << int(name[-2:])
+        if result_type == 'f32':
+            if abs(a) > 2 ** 53:
+                return None  # cannot round in two steps
+            return _round_f32(float(a))
+        return float(a)  # correctly rounded
+    elif name == 'demote_f64':
+        return _round_f32(a)
+    elif name == 'promote_f32':
+        return a
+    elif op == 'i32.reinterpret_f32':
+        return unpack('<i', pack('<f', a))[0]
+    elif op == 'i64.reinterpret_f64':
+        return unpack('<q', pack('<d', a))[0]
+    elif op == 'f32.reinterpret_i32':
+        return unpack('<f', pack('<i', a))[0]
+    elif op == 'f64.reinterpret_i64':
+        return unpack('<d', pack('<q', a))[0]
+
+
+def _evaluate(op, args):
+    # Evaluate a pure instruction for the given constant operands, with the
+    # semantics of WASM. Returns None if it cannot be evaluated exactly.
+    pops, pushes = STACK_EFFECTS[op]
+    values = []
+    for arg, type in zip(args, pops):
+        if type[0] == 'i':
+            values.append(_to_signed(int(arg), int(type[1:])))
+        else:
+            value = float(arg)
+            if math.isnan(value) and not op.split('.')[1] in ('eq', 'ne', 'lt', 'gt', 'le', 'ge'):
+                return None  # the payload of NaN results is not deterministic
+            values.append(_round_f32(value) if type == 'f32' else value)
+    op_type, name = op.split('.')
+    if op_type[0] == 'i' and name in _INT_OPS:
+        result = _INT_OPS[name](*values, int(op_type[1:]))
+    elif op_type[0] == 'f' and name in _FLOAT_OPS:
+        result = _FLOAT_OPS[name](*values)
+    else:
+        result = _convert(op, *values)
+    if result is None:
+        return None
+    elif pushes[0][0] == 'i':
+        return _to_signed(result, int(pushes[0][1:]))
+    elif math.isnan(result) and 'reinterpret' in op:
+        return None  # keep the bit pattern as it is
+    return _round_f32(result) if pushes[0] == 'f32' else result
+
+
+def _fold(*instructions):
+    # Replace a pure instruction with constant operands by its result
+    op = instructions[-1].type
+    result = _evaluate(op, [instruction.args[0] for instruction in instructions[:-1]])
+    if result is not None:
+        return [Instruction(STACK_EFFECTS[op][1][0] + '.const', result)]
+
+
+def _fold_select(value1, value2, condition, select):
+    return [value1 if _to_signed(condition.args[0], 32) else value2]
+
+
+# Rules for the numeric instructions, and select. Instructions that can trap
+# are only folded if they do not trap for the given operands.
+FOLDING_RULES = [
+    (tuple(type + '.const' for type in STACK_EFFECTS[name][0]) + (name, ), _fold)
+    for name in OPCODES if OPCODES[name] >= 0x45
+    ] + [
+    ((type + '.const', type + '.const', 'i32.const', 'select'), _fold_select)
+    for type in ('i32', 'i64', 'f32', 'f64')
+    ]
+
+
+def _get_local_type(functiondef, num_params, index):
+    return functiondef.locals[index - num_params]
+
+
+def _propagate_constants(functiondef, num_params, instructions):
+    # Replace reads of locals (not params) that only ever hold a single
+    # constant value with that constant, and remove the writes. A local that
+    # is not written holds zero. A local that is written once, at the top
+    # level of the function (so not in a loop), holds the value for all
+    # reads that come after the write. Returns the new list of instructions,
+    # or None if there are no such locals.
+    writes = {}  # local index -> list of positions
+    reads = {}
+    depths = []  # block depth of each write
+    depth = 0
+    for i, instruction in enumerate(instructions):
+        type = instruction.type
+        if type in ('get_local', 'set_local', 'tee_local'):
+            index = instruction.args[0]
+            if index >= num_params:
+                (reads if type == 'get_local' else writes).setdefault(index, []).append(i)
+                if type != 'get_local':
+                    depths.append((i, depth))
+        elif type in ('block', 'loop', 'if'):
+            depth += 1
+        elif type == 'end':
+            depth -= 1
+    depth_at = dict(depths)
+    
+    constants = {}  # local index -> const instruction
+    removed = set()  # positions of instructions to remove
+    for index in reads:
+        positions = writes.get(index, ())
+        local_type = _get_local_type(functiondef, num_params, index)
+        zero = Instruction(local_type + '.const', 0.0 if local_type[0] == 'f' else 0)
+        if not positions:
+            constants[index] = zero
+            continue
+        elif len(positions) != 1:
+            continue
+        pos = positions[0]
+        const = instructions[pos - 1] if pos else None
+        if const is None or const.type != local_type + '.const':
+            continue
+        value = const.args[0]
+        is_zero = value == 0 and not (local_type[0] == 'f' and copysign(1.0, value) < 0)
+        if is_zero or (depth_at[pos] == 0 and min(reads[index]) > pos):
+            constants[index] = const
+            if instructions[pos].type == 'set_local':
+                removed.update((pos - 1, pos))
+            else:
+                removed.add(pos)  # the tee_local leaves the value on the stack
+    if not constants:
+        return None
+    result = []
+    for i, instruction in enumerate(instructions):
+        if i in removed:
+            continue
+        elif instruction.type == 'get_local' and instruction.args[0] in constants:
+            instruction = constants[instruction.args[0]]
+        result.append(instruction)
+    return result
+
+
+class _Body:
+    """ Stand-in for a FunctionDef, to apply a pass to a list of
+    instructions before assigning them to the function definition.
+    """
+    
+    __slots__ = ['instructions']
+    
+    def __init__(self, instructions):
+        self.instructions = instructions
+
+
+def fold_constants(functiondef, num_params=0, returns=None):
+    """ Evaluate pure instructions whose operands are constants, and replace
+    the reads of locals that only hold a single constant with that constant.
+    Evaluation follows the semantics of WASM: integers wrap, and floats are
+    IEEE 754 (with f32 results rounded to single precision). Instructions
+    that would trap (e.g. division by zero) are not folded. Returns whether
+    the function definition was changed.
+    """
+    instructions = list(_iter_flat(functiondef.instructions))
+    changed = False
+    while True:
+        temp = _Body(instructions)
+        if peephole(temp, num_params, returns, FOLDING_RULES):
+            instructions = temp.instructions
+            changed = True
+        propagated = _propagate_constants(functiondef, num_params, instructions)
+        if propagated is None:
+            break
+        instructions = propagated
+        changed = True
+    if changed:
+        functiondef.instructions = instructions
+    return changed
+
+
+
+## Control flow
+
+# The body of a function is turned into a tree, in which each block, loop
+# and if is a _Block, and branches refer to _Label objects instead of
+# depths. This allows removing and merging blocks; the depths are computed
+# again when the tree is turned back into a list of instructions.
+
+class _Label:
+    """ The target of branches. Labels of blocks that are merged point
+    to the label of the block they are merged into.
+    """
+    
+    __slots__ = ['uses', 'target']
+    
+    def __init__(self):
+        self.uses = 0  # number of branches to this label
+        self.target = None
+    
+    def get(self):
+        label = self
+        while label.target is not None:
+            label = label.target
+        return label
+
+
+class _Block:
+    """ A block, loop or if, with its instructions (and those of the else).
+    """
+    
+    __slots__ = ['type', 'block_type', 'label', 'body', 'else_body', 'round']
+    
+    def __init__(self, type, block_type):
+        self.type = type
+        self.block_type = block_type
+        self.label = _Label()
+        self.body = []
+        self.else_body = None
+        self.round = -1  # the last round in which the block was simplified
+    
+    def get_arity(self):
+        return 0 if self.block_type == 'emptyblock' else 1
+
+
+class _Branch:
+    """ A br, br_if or br_table, with the labels that it can branch to (for
+    br_table, the default label comes last).
+    """
+    
+    __slots__ = ['type', 'labels']
+    
+    def __init__(self, type, labels):
+        self.type = type
+        self.labels = labels
+
+
+_ELSE = Instruction('else')
+_END = Instruction('end')
+_DROP = Instruction('drop')
+_EQZ = Instruction('i32.eqz')
+_UNREACHABLE = Instruction('unreachable')
+
+
+def _parse_tree(instructions, function_label):
+    # Turn a flat list of instructions into a tree. Returns None if the
+    # blocks are not properly nested.
+    root = []
+    bodies = [root]
+    blocks = [None]
+    labels = [function_label]
+    for instruction in instructions:
+        type = instruction.type
+        if type in ('block', 'loop', 'if'):
+            block = _Block(type, instruction.args[0])
+            bodies[-1].append(block)
+            bodies.append(block.body)
+            blocks.append(block)
+            labels.append(block.label)
+        elif type == 'else':
+            block = blocks[-1]
+            if block is None or block.type != 'if' or block.else_body is not None:
+                return None
+            block.else_body = bodies[-1] = []
+        elif type == 'end':
+            if len(bodies) == 1:
+                return None
+            bodies.pop()
+            blocks.pop()
+            labels.pop()
+        elif type in ('br', 'br_if', 'br_table'):
+            depths = list(instruction.args[0]) + [instruction.args[1]] if type == 'br_table' else \
+                [instruction.args[0]]
+            if max(depths) >= len(labels):
+                return None
+            branch_labels = [labels[-1 - depth] for depth in depths]
+            for label in branch_labels:
+                label.uses += 1
+            bodies[-1].append(_Branch(type, branch_labels))
+        else:
+            bodies[-1].append(instruction)
+    return root if len(bodies) == 1 else None
+
+
+def _flatten_tree(body, labels, result):
+    # Turn a tree back into a flat list of instructions
+    for node in body:
+        if isinstance(node, _Block):
+            result.append(Instruction(node.type, node.block_type))
+            labels[node.label] = len(labels)
+            _flatten_tree(node.body, labels, result)
+            if node.else_body is not None:
+                result.append(_ELSE)
+                _flatten_tree(node.else_body, labels, result)
+            del labels[node.label]
+            result.append(_END)
+        elif isinstance(node, _Branch):
+            depths = [len(labels) - 1 - labels[label.get()] for label in node.labels]
+            if node.type == 'br_table':
+                result.append(Instruction('br_table', depths[:-1], depths[-1]))
+            else:
+                result.append(Instruction(node.type, depths[0]))
+        else:
+            result.append(node)
+
+
+def _release(nodes):
+    # Nodes are removed; update the use counts of the labels they branch to
+    for node in nodes:
+        if isinstance(node, _Block):
+            _release(node.body)
+            _release(node.else_body or ())
+        elif isinstance(node, _Branch):
+            for label in node.labels:
+                label.get().uses -= 1
+
+
+def _get_height_change(node):
+    # Get how much an instruction changes the height of the stack, or None
+    # if that is not known (for calls).
+    type = node.type
+    if isinstance(node, _Block):
+        return node.get_arity() - (type == 'if')
+    elif type in ('get_local', 'get_global'):
+        return 1
+    elif type in ('set_local', 'set_global', 'drop', 'br_if'):
+        return -1
+    elif type == 'select':
+        return -2
+    elif type == 'tee_local':
+        return 0
+    effect = STACK_EFFECTS[type]
+    return None if effect is None else len(effect[1]) - len(effect[0])
+
+
+def _is_const_condition(nodes):
+    return nodes and isinstance(nodes[-1], Instruction) and nodes[-1].type == 'i32.const'
+
+
+class _ControlFlowSimplifier:
+    """ Simplifies the tree of a function body in rounds, until nothing
+    changes.
+    """
+    
+    def __init__(self, function_label):
+        self.function_label = function_label
+        self.round = 0
+        self.changed = False
+    
+    def simplify_body(self, body, end_label, arity):
+        # Simplify a list of nodes. The end_label is the label that branches
+        # to the end of the body (None for loops), and arity the number of
+        # values at the end (None if not known). Returns (new body, whether
+        # the end of the body is reached).
+        result = []
+        reachable = True
+        after_block = False  # whether the code is not reached because of a block
+        todo = list(reversed(body))
+        while todo:
+            node = todo.pop()
+            if not reachable:
+                # For validation, the code after a block is reachable, so an
+                # unreachable instruction takes the place of removed code.
+                if after_block:
+                    after_block = False
+                    if isinstance(node, Instruction) and node.type == 'unreachable':
+                        result.append(node)
+                        continue  # already there
+                    result.append(_UNREACHABLE)
+                _release([node])
+                self.changed = True
+                continue
+            if isinstance(node, _Block):
+                if node.round != self.round:
+                    node.round = self.round
+                    if node.type == 'if' and _is_const_condition(result):
+                        # Keep the branch that is taken, as a block
+                        condition = result.pop()
+                        taken, other = node.body, node.else_body or []
+                        if not condition.args[0]:
+                            taken, other = other, taken
+                        _release(other)
+                        node.type, node.body, node.else_body = 'block', taken, None
+                        self.changed = True
+                    nodes = self.simplify_block(node)
+                    if nodes is not None:
+                        todo.extend(reversed(nodes))  # replaces the block
+                        continue
+                reachable = self.falls_through(node)
+                after_block = not reachable
+            elif isinstance(node, _Branch):
+                if node.type != 'br' and _is_const_condition(result):
+                    condition = result.pop()
+                    _release([node])
+                    self.changed = True
+                    if node.type == 'br_if' and not condition.args[0]:
+                        continue  # never taken
+                    index = condition.args[0] % (1 << 32) if node.type == 'br_table' else 0
+                    label = node.labels[min(index, len(node.labels) - 1)].get()
+                    label.uses += 1
+                    node = _Branch('br', [label])
+                reachable = node.type == 'br_if'
+            elif node.type in ('return', 'unreachable'):
+                reachable = False
+            result.append(node)
+        
+        # Remove branches at the end of the body to the end of the body. A br
+        # is only removed if the stack has the values for the end.
+        while result and end_label is not None:
+            node = result[-1]
+            if isinstance(node, _Branch) and node.type == 'br_if' and \
+                    node.labels[0].get() is end_label.get():
+                result[-1] = _DROP  # the condition
+            elif (isinstance(node, _Branch) and node.type == 'br' and
+                    node.labels[0].get() is end_label.get()) or \
+                    (node.type == 'return' and end_label is self.function_label):
+                if arity is None or _get_height(result[:-1]) != arity:
+                    break
+                result.pop()
+            else:
+                break
+            _release([node])
+            reachable = True
+            self.changed = True
+        return result, reachable
+    
+    def simplify_block(self, block):
+        # Simplify the body of a block. Returns a list of nodes to replace the
+        # block with, or None to keep it.
+        arity = block.get_arity()
+        if block.type == 'loop':
+            block.body, falls = self.simplify_body(block.body, None, arity)
+        else:
+            block.body, falls = self.simplify_body(block.body, block.label, arity)
+            self.merge_last_block(block.body, block.label, block.block_type)
+        if block.else_body is not None:
+            block.else_body, falls = self.simplify_body(block.else_body, block.label, arity)
+            self.merge_last_block(block.else_body, block.label, block.block_type)
+            if not block.else_body:
+                block.else_body = None
+                self.changed = True
+        if block.type != 'if' and block.label.get().uses == 0:
+            self.changed = True
+            return block.body  # nothing branches to the block, so it is not needed
+        elif block.type == 'if' and not block.body and not arity:
+            self.changed = True
+            if block.else_body is None:
+                return [_DROP]  # only the condition is left
+            # Invert the condition, so that the else is not needed
+            block.body, block.else_body = block.else_body, None
+            return [_EQZ, block]
+        return None
+    
+    def merge_last_block(self, body, label, block_type):
+        # A block at the end of a body ends at the same place as the body, so
+        # its branches can go to the label of the body instead (if the types
+        # match). Then the block is not needed anymore.
+        if body and isinstance(body[-1], _Block) and body[-1].type == 'block' and \
+                body[-1].block_type == block_type:
+            inner = body.pop()
+            inner_label = inner.label.get()
+            inner_label.target = label.get()
+            inner_label.target.uses += inner_label.uses
+            body.extend(inner.body)
+            self.changed = True
+    
+    def falls_through(self, block):
+        # Whether the code after the block can be reached
+        if block.type == 'loop':
+            return self.body_falls_through(block.body)
+        elif block.label.get().uses or block.else_body is None and block.type == 'if':
+            return True
+        return self.body_falls_through(block.body) or \
+            (block.else_body is not None and self.body_falls_through(block.else_body))
+    
+    def body_falls_through(self, body):
+        # Whether the end of a (simplified) body is reached
+        if not body:
+            return True
+        node = body[-1]
+        if isinstance(node, _Block):
+            return self.falls_through(node)
+        return node.type not in ('br', 'br_table', 'return', 'unreachable')
+
+
+def _get_height(nodes):
+    # Get the height of the stack after the given (reachable) nodes, or None
+    height = 0
+    for node in nodes:
+        change = _get_height_change(node)
+        if change is None:
+            return None
+        height += change
+    return height
+
+
+def cleanup_control_flow(functiondef, num_params=0, returns=None):
+    """ Simplify the control flow of the given function definition: remove
+    the code after unconditional branches (and after blocks that are not
+    left), replace branches and ifs with a constant condition by what is
+    taken, remove branches to where the code goes anyway, remove blocks and
+    loops that are not branched to, and merge blocks that end at the same
+    place. The depths of branches are adjusted accordingly. If the result
+    types of the function are not given, the end of the function is left
+    alone. Returns whether the function definition was changed.
+    """
+    instructions = list(_iter_flat(functiondef.instructions))
+    if not any(instruction.type in _CONTROL_INSTRUCTIONS for instruction in instructions):
+        return False
+    function_label = _Label()
+    body = _parse_tree(instructions, function_label)
+    if body is None:
+        return False  # not valid, leave it alone
+    if returns is None:
+        arity = block_type = None
+    else:
+        arity = len(returns)
+        block_type = returns[0] if returns else 'emptyblock'
+    simplifier = _ControlFlowSimplifier(function_label)
+    changed = False
+    while True:
+        simplifier.changed = False
+        body, falls = simplifier.simplify_body(body, function_label, arity)
+        if block_type is not None:
+            simplifier.merge_last_block(body, function_label, block_type)
+        if not simplifier.changed:
+            break
+        simplifier.round += 1
+        changed = True
+    if changed:
+        result = []
+        _flatten_tree(body, {function_label: 0}, result)
+        functiondef.instructions = result
+    return changed
+
+
+_CONTROL_INSTRUCTIONS = frozenset(['block', 'loop', 'if', 'br', 'br_if', 'br_table', 'return',
+                                   'unreachable'])
+
+
+
+## Locals
+
+def _get_interference(cfg):
+    # Get for each local a mask of the locals that it interferes with, i.e.
+    # that are live where it is set (so that they cannot share a local).
+    # At the start of the function all locals are set (to the arguments
+    # or zero). A local that is set to the value of another local does not
+    # interfere with it because of that.
+    interference = [cfg.entry.live_in] * cfg.num_locals
+    for block in cfg.blocks:
+        instructions = block.instructions
+        for i, live in enumerate(block.get_live_after()):
+            instruction = instructions[i]
+            if instruction.type in ('set_local', 'tee_local'):
+                if i and instructions[i - 1].type == 'get_local':
+                    live &= ~(1 << instructions[i - 1].args[0])  # a copy
+                interference[instruction.args[0]] |= live
+    # Make it symmetric, and not interfere with itself
+    for index in range(cfg.num_locals):
+        for other in _iter_bits(interference[index]):
+            interference[other] |= 1 << index
+    for index in range(cfg.num_locals):
+        interference[index] &= ~(1 << index)
+    return interference
+
+
+def coalesce_locals(functiondef, num_params=0, returns=None):
+    """ Let locals (that are not parameters) of the same type share a single
+    local if their values are never needed at the same time, based on the
+    liveness of the locals. Locals that are not used at all are removed.
+    A local that is copied into another can share it, in which case the
+    copy (`get_local x; set_local x`) is removed by the peephole pass.
+    Returns whether the function definition was changed.
+    """
+    if len(functiondef.locals) < 2:
+        return False
+    try:
+        cfg = ControlFlowGraph(functiondef, num_params)
+    except ValueError:
+        return False  # not valid, leave it alone
+    cfg.compute_liveness()
+    interference = _get_interference(cfg)
+    # Greedily assign each local to the first shared local that it fits in
+    shared_types, shared_masks = [], []
+    remap = {}
+    for index in range(num_params, cfg.num_locals):
+        loc_type = functiondef.locals[index - num_params]
+        for j, mask in enumerate(shared_masks):
+            if shared_types[j] == loc_type and not mask & interference[index]:
+                shared_masks[j] |= 1 << index
+                break
+        else:
+            j = len(shared_masks)
+            shared_types.append(loc_type)
+            shared_masks.append(1 << index)
+        remap[index] = num_params + j
+    if len(shared_types) == len(functiondef.locals):
+        return False
+    functiondef.instructions = [instruction._remap_locals(remap)
+                                for instruction in cfg.to_instructions()]
+    functiondef.locals = shared_types
+    return True
+
+
+DEFAULT_PASSES = [fold_constants, cleanup_control_flow, coalesce_locals, peephole]
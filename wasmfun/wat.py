@@ -0,0 +1,576 @@
+"""
+Parser for the WebAssembly text format (WAT).
+"""
+
+import re
+from math import copysign, inf, nan
+from struct import pack, unpack
+
+from ._opcodes import OPCODE_IMMEDIATES, WAT_NAMES
+from .components import (Module, TypeSection, ImportSection, FunctionSection, MemorySection,
+                         ExportSection, StartSection, CodeSection, DataSection,
+                         FunctionSig, Import, Export, FunctionDef, Instruction)
+
+
+__all__ = ['parse_wat']
+
+
+# Tokens are parens, strings and atoms (keywords, numbers, ids). Whitespace
+# and line comments match too, but give an empty token. A stray quote or
+# semicolon gives a token that the parser rejects. Block comments (which
+# can be nested) are removed before tokenizing.
+_TOKEN_RE = re.compile(r'\s+|;;[^\n]*|(\(|\)|"(?:[^"\\]|\\.)*"|[^\s()";]+|["\';])',
+                       re.DOTALL)
+_COMMENT_START_RE = re.compile(r'"(?:[^"\\]|\\.)*"|;;[^\n]*|\(;', re.DOTALL)
+_COMMENT_PART_RE = re.compile(r'\(;|;\)')
+
+_HEX_STRING_RE = re.compile(r'(?:\\[0-9a-fA-F]{2})+\Z')
+_STRING_ESCAPE_RE = re.compile(rb'\\([0-9a-fA-F]{2}|u\{[0-9a-fA-F]+\}|.)', re.DOTALL)
+_STRING_ESCAPES = {b'n': b'\n', b't': b'\t', b'r': b'\r', b'\\': b'\\', b"'": b"'", b'"': b'"'}
+
+# Map names in the text format (and the names used by wasmfun) to instruction types
+_INSTRUCTION_TYPES = {wat_name: name for name, wat_name in WAT_NAMES.items()}
+_INSTRUCTION_TYPES.update({name: name for name in WAT_NAMES})
+
+_BLOCK_TYPES = ('block', 'loop', 'if')
+
+
+def parse_wat(text):
+    """ Parse a module in the WebAssembly text format and return a Module
+    object. Supports flat and folded instructions, named (and numbered)
+    types, functions, locals and labels, function imports and exports,
+    memory, data, and the start function. Function names are available
+    (without the leading $) in the module's `func_id_to_index`.
+    """
+    return _WatParser(_parse_sexpr(text)).get_module()
+
+
+def _strip_block_comments(text):
+    # Replace (nested) block comments with a space. Outside of comments,
+    # strings and line comments are skipped, because they can contain "(;".
+    parts = []
+    pos = 0
+    while True:
+        match = _COMMENT_START_RE.search(text, pos)
+        if match is None:
+            break
+        elif match.group() != '(;':
+            parts.append(text[pos:match.end()])
+            pos = match.end()
+            continue
+        parts.append(text[pos:match.start()] + ' ')
+        depth = 1
+        pos = match.end()
+        while depth:
+            match = _COMMENT_PART_RE.search(text, pos)
+            if match is None:
+                raise ValueError('Missing ";)" at end of WAT.')
+            depth += 1 if match.group() == '(;' else -1
+            pos = match.end()
+    parts.append(text[pos:])
+    return ''.join(parts)
+
+
+def _parse_sexpr(text):
+    # Tokenize the text and turn it into nested lists
+    if '(;' in text:
+        text = _strip_block_comments(text)
+    stack = [[]]
+    for token in _TOKEN_RE.findall(text):
+        if not token:
+            continue
+        elif token == '(':
+            stack.append([])
+        elif token == ')':
+            if len(stack) == 1:
+                raise ValueError('Unexpected ")" in WAT.')
+            expr = stack.pop()
+            stack[-1].append(expr)
+        elif token in ('"', "'", ';'):
+            raise ValueError('Unexpected %r in WAT.' % token)
+        else:
+            stack[-1].append(token)
+    if len(stack) > 1:
+        raise ValueError('Missing ")" at end of WAT.')
+    exprs = stack[0]
+    if len(exprs) == 1 and isinstance(exprs[0], list) and exprs[0] and exprs[0][0] == 'module':
+        fields = exprs[0][1:]
+        return fields[1:] if fields and _is_id(fields[0]) else fields  # skip the module id
+    return exprs  # module fields without the (module ...)
+
+
+def _is_id(item):
+    return isinstance(item, str) and item.startswith('$')
+
+
+def _is_string(item):
+    return isinstance(item, str) and item.startswith('"')
+
+
+def _parse_string(token):
+    # Parse a string token into bytes
+    body = token[1:-1]
+    if _HEX_STRING_RE.match(body):
+        return bytes.fromhex(body.replace('\\', ''))  # fast path for escaped data
+    return _STRING_ESCAPE_RE.sub(_replace_escape, body.encode('utf-8'))
+
+
+def _replace_escape(match):
+    escape = match.group(1)
+    if escape in _STRING_ESCAPES:
+        return _STRING_ESCAPES[escape]
+    elif escape.startswith(b'u{'):
+        return chr(int(escape[2:-1], 16)).encode('utf-8')
+    elif len(escape) == 2:
+        return bytes.fromhex(escape.decode())
+    raise ValueError('Invalid escape in WAT string: \\%s' % escape.decode())
+
+
+def _parse_int(token, bits):
+    # Parse an integer, and wrap unsigned values to signed
+    s = token.replace('_', '')
+    sign = 1
+    if s[:1] in '+-':
+        sign = -1 if s[0] == '-' else 1
+        s = s[1:]
+    try:
+        value = sign * (int(s[2:], 16) if s[:2] == '0x' else int(s, 10))
+    except ValueError:
+        raise ValueError('Invalid integer in WAT: %r' % token) from None
+    if not -2 ** (bits - 1) <= value < 2 ** bits:
+        raise ValueError('Integer out of range in WAT: %r' % token)
+    return value - 2 ** bits if value >= 2 ** (bits - 1) else value
+
+
+def _parse_float(token, bits):
+    s = token.replace('_', '')
+    sign = -1.0 if s.startswith('-') else 1.0
+    s = s.lstrip('+-')
+    if s == 'inf':
+        return sign * inf
+    elif s == 'nan':
+        return copysign(nan, sign)  # multiplying does not set the sign of a NaN
+    elif s.startswith('nan:0x'):
+        # NaN with payload
+        if bits == 32:
+            sign_bit = 0x80000000 if sign < 0 else 0
+            return unpack('<f', pack('<I', sign_bit | 0x7f800000 | int(s[6:], 16)))[0]
+        sign_bit = 0x8000000000000000 if sign < 0 else 0
+        return unpack('<d', pack('<Q', sign_bit | 0x7ff0000000000000 | int(s[6:], 16)))[0]
+    try:
+        if s.startswith('0x'):
+            return sign * float.fromhex(s)
+        return sign * float(s)
+    except ValueError:
+        raise ValueError('Invalid float in WAT: %r' % token) from None
+
+
+class _WatParser:
+    """ Turns the module fields (as nested lists) into a Module.
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.functionsigs = []
+        self.type_names = {}
+        self.sig_indices = {}  # (params, returns) -> index
+        self.imports = []
+        self.func_names = {}
+        self.funcs = []  # (field, sig index, param names)
+        self.exports = []
+        self.memories = []
+        self.data = []
+        self.start = None
+
+    def get_module(self):
+        # First pass: collect types, and the function index space
+        for field in self.fields:
+            kind = field[0] if isinstance(field, list) and field else None
+            if kind == 'type':
+                self._parse_type(field)
+        for field in self.fields:
+            kind = field[0] if isinstance(field, list) and field else None
+            if kind == 'type':
+                pass
+            elif kind == 'import':
+                self._parse_import(field)
+            elif kind == 'func':
+                self._parse_func_header(field)
+            elif kind == 'memory':
+                self._parse_memory(field)
+            elif kind in ('export', 'start', 'data'):
+                pass  # second pass
+            else:
+                raise ValueError('Unsupported module field in WAT: %s' % _to_text(field))
+        # Second pass: parse what refers to functions
+        functiondefs = [self._parse_func_body(*func) for func in self.funcs]
+        for field in self.fields:
+            if field[0] == 'export':
+                self._parse_export(field)
+            elif field[0] == 'start':
+                self.start = self._get_func_index(field[1])
+            elif field[0] == 'data':
+                self._parse_data(field)
+
+        # Compose module
+        sections = [TypeSection(*self.functionsigs)]
+        if self.imports:
+            sections.append(ImportSection(*self.imports))
+        sections.append(FunctionSection(*[func[1] for func in self.funcs]))
+        if self.memories:
+            sections.append(MemorySection(*self.memories))
+        if self.exports:
+            sections.append(ExportSection(*self.exports))
+        if self.start is not None:
+            sections.append(StartSection(self.start))
+        sections.append(CodeSection(*functiondefs))
+        if self.data:
+            sections.append(DataSection(*self.data))
+        module = Module(*sections)
+        module.func_id_to_index = {name[1:]: index for name, index in self.func_names.items()}
+        return module
+
+    def _get_sig_index(self, params, returns):
+        # Get the index of the signature, reusing an existing signature
+        key = tuple(params), tuple(returns)
+        index = self.sig_indices.get(key)
+        if index is None:
+            index = self.sig_indices[key] = len(self.functionsigs)
+            self.functionsigs.append(FunctionSig(list(params), list(returns)))
+        return index
+
+    def _parse_type(self, field):
+        items = field[1:]
+        if items and _is_id(items[0]):
+            self.type_names[items[0]] = len(self.functionsigs)
+            items = items[1:]
+        if len(items) != 1 or not isinstance(items[0], list) or items[0][:1] != ['func']:
+            raise ValueError('Unsupported type in WAT: %s' % _to_text(field))
+        params, param_names, returns, rest = self._parse_signature(items[0][1:])
+        # Explicit types are not merged with other types
+        key = tuple(params), tuple(returns)
+        self.sig_indices.setdefault(key, len(self.functionsigs))
+        self.functionsigs.append(FunctionSig(params, returns))
+
+    def _parse_signature(self, items):
+        # Parse params and results. Returns (params, param_names, returns, rest).
+        params, param_names, returns = [], {}, []
+        i = 0
+        while i < len(items) and isinstance(items[i], list) and items[i][:1] in (['param'], ['result']):
+            item = items[i]
+            if item[0] == 'param':
+                if len(item) == 3 and _is_id(item[1]):
+                    param_names[item[1]] = len(params)
+                    params.append(item[2])
+                else:
+                    params.extend(item[1:])
+            else:
+                returns.extend(item[1:])
+            i += 1
+        return params, param_names, returns, items[i:]
+
+    def _parse_type_use(self, items):
+        # Parse (type x) and/or params and results. Returns (sig_index, param_names, rest).
+        type_index = None
+        if items and isinstance(items[0], list) and items[0][:1] == ['type']:
+            type_index = self._get_index(items[0][1], self.type_names, 'type')
+            items = items[1:]
+        params, param_names, returns, items = self._parse_signature(items)
+        if type_index is None:
+            return self._get_sig_index(params, returns), param_names, items
+        if type_index >= len(self.functionsigs):
+            raise ValueError('Type index %i out of range in WAT.' % type_index)
+        functionsig = self.functionsigs[type_index]
+        if (params or returns) and (list(functionsig.params), list(functionsig.returns)) != (params, returns):
+            raise ValueError('Signature does not match type %i in WAT.' % type_index)
+        return type_index, param_names, items
+
+    def _parse_import(self, field):
+        if len(field) != 4 or not isinstance(field[3], list) or field[3][:1] != ['func']:
+            raise ValueError('Only functions can be imported for now: %s' % _to_text(field))
+        desc = field[3][1:]
+        if desc and _is_id(desc[0]):
+            self._add_func_name(desc[0])
+            desc = desc[1:]
+        if self.funcs:
+            raise ValueError('Imports must come before functions in WAT.')
+        sig_index, param_names, rest = self._parse_type_use(desc)
+        self.imports.append(Import(_parse_string(field[1]).decode('utf-8'),
+                                   _parse_string(field[2]).decode('utf-8'), 'function', sig_index))
+
+    def _add_func_name(self, name):
+        if name in self.func_names:
+            raise ValueError('Duplicate function name %s in WAT.' % name)
+        self.func_names[name] = len(self.imports) + len(self.funcs)
+
+    def _parse_func_header(self, field):
+        items = field[1:]
+        if items and _is_id(items[0]):
+            self._add_func_name(items[0])
+            items = items[1:]
+        index = len(self.imports) + len(self.funcs)
+        while items and isinstance(items[0], list) and items[0][:1] == ['export']:
+            self.exports.append(Export(_parse_string(items[0][1]).decode('utf-8'), 'function', index))
+            items = items[1:]
+        if items and isinstance(items[0], list) and items[0][:1] == ['import']:
+            if self.funcs:
+                raise ValueError('Imports must come before functions in WAT.')
+            sig_index, param_names, rest = self._parse_type_use(items[1:])
+            self.imports.append(Import(_parse_string(items[0][1]).decode('utf-8'),
+                                       _parse_string(items[0][2]).decode('utf-8'),
+                                       'function', sig_index))
+            return
+        sig_index, param_names, items = self._parse_type_use(items)
+        self.funcs.append((items, sig_index, param_names))
+
+    def _parse_memory(self, field):
+        items = field[1:]
+        if items and _is_id(items[0]):
+            items = items[1:]
+        if not 1 <= len(items) <= 2 or not all(isinstance(i, str) for i in items):
+            raise ValueError('Unsupported memory in WAT: %s' % _to_text(field))
+        self.memories.append(tuple(_parse_int(i, 33) for i in items))
+
+    def _parse_export(self, field):
+        if len(field) != 3 or not isinstance(field[2], list) or field[2][:1] != ['func']:
+            raise ValueError('Only functions can be exported for now: %s' % _to_text(field))
+        index = self._get_func_index(field[2][1])
+        self.exports.append(Export(_parse_string(field[1]).decode('utf-8'), 'function', index))
+
+    def _parse_data(self, field):
+        items = field[1:]
+        if items and _is_id(items[0]):
+            items = items[1:]  # data name
+        if items and isinstance(items[0], list) and items[0][:1] == ['memory']:
+            items = [items[0][1]] + items[1:]
+        if items and isinstance(items[0], str) and not _is_string(items[0]):
+            if _is_id(items[0]) or _parse_int(items[0], 32) != 0:
+                raise ValueError('Only memory 0 is supported in WAT data.')
+            items = items[1:]  # memory index
+        if not items or not isinstance(items[0], list):
+            raise ValueError('Data in WAT needs an offset: %s' % _to_text(field))
+        offset = items[0]
+        if offset[:1] == ['offset']:
+            offset = offset[1] if len(offset) == 2 else offset[1:]
+        if offset[:1] != ['i32.const'] or len(offset) != 2:
+            raise ValueError('Data in WAT needs an i32.const offset: %s' % _to_text(field))
+        data = b''.join(_parse_string(i) for i in items[1:])
+        self.data.append((0, _parse_int(offset[1], 32), data))
+
+    def _get_index(self, item, names, what):
+        if isinstance(item, str) and item.startswith('$'):
+            try:
+                return names[item]
+            except KeyError:
+                raise ValueError('Unknown %s %s in WAT.' % (what, item)) from None
+        elif isinstance(item, str):
+            return _parse_int(item, 33)
+        raise ValueError('Expected %s index in WAT, got %s' % (what, _to_text(item)))
+
+    def _get_func_index(self, item):
+        return self._get_index(item, self.func_names, 'function')
+
+    def _parse_func_body(self, items, sig_index, param_names):
+        functionsig = self.functionsigs[sig_index]
+        local_names = dict(param_names)
+        locals = []
+        nparams = len(functionsig.params)
+        while items and isinstance(items[0], list) and items[0][:1] == ['local']:
+            item = items[0]
+            if len(item) == 3 and _is_id(item[1]):
+                local_names[item[1]] = nparams + len(locals)
+                locals.append(item[2])
+            else:
+                locals.extend(item[1:])
+            items = items[1:]
+        body = _BodyParser(self, local_names)
+        body.parse_instructions(items)
+        return FunctionDef(locals, *body.instructions)
+
+
+class _BodyParser:
+    """ Turns the (flat or folded) instructions of a function into
+    Instruction objects.
+    """
+
+    def __init__(self, parser, local_names):
+        self.parser = parser
+        self.local_names = local_names
+        self.labels = [None]  # label names, the function itself is the outer label
+        self.instructions = []
+
+    def parse_instructions(self, items):
+        i = 0
+        while i < len(items):
+            item = items[i]
+            if isinstance(item, list):
+                self.parse_folded(item)
+                i += 1
+            else:
+                i = self.parse_flat(items, i)
+
+    def get_type(self, keyword):
+        try:
+            return _INSTRUCTION_TYPES[keyword.replace('/', '_')]
+        except (KeyError, AttributeError):
+            raise ValueError('Unknown instruction in WAT: %s' % _to_text(keyword)) from None
+
+    def parse_flat(self, items, i):
+        # Parse a flat instruction with its immediates. Returns the new index.
+        type = self.get_type(items[i])
+        i += 1
+        if type in _BLOCK_TYPES:
+            label, block_type, i = self.parse_block_header(items, i)
+            self.labels.append(label)
+            self.instructions.append(Instruction(type, block_type))
+            return i
+        elif type in ('else', 'end'):
+            if i < len(items) and _is_id(items[i]):
+                i += 1  # optional label
+            if type == 'end':
+                if len(self.labels) == 1:
+                    raise ValueError('Unexpected "end" in WAT.')
+                self.labels.pop()
+            self.instructions.append(Instruction(type))
+            return i
+        args, i = self.parse_immediates(type, items, i)
+        self.instructions.append(Instruction(type, *args))
+        return i
+
+    def parse_block_header(self, items, i):
+        # Parse optional label and result type. Returns (label, block_type, index).
+        label = None
+        if i < len(items) and _is_id(items[i]):
+            label = items[i]
+            i += 1
+        block_type = 'emptyblock'
+        if i < len(items) and isinstance(items[i], list) and items[i][:1] == ['result']:
+            if len(items[i]) != 2:
+                raise ValueError('Blocks can have at most one result in WAT.')
+            block_type = items[i][1]
+            i += 1
+        return label, block_type, i
+
+    def parse_folded(self, item):
+        keyword = item[0]
+        type = self.get_type(keyword)
+        if type in ('block', 'loop'):
+            label, block_type, i = self.parse_block_header(item, 1)
+            self.instructions.append(Instruction(type, block_type))
+            self.labels.append(label)
+            self.parse_instructions(item[i:])
+            self.labels.pop()
+            self.instructions.append(Instruction('end'))
+        elif type == 'if':
+            label, block_type, i = self.parse_block_header(item, 1)
+            rest = item[i:]
+            # The condition comes before the (then ...) and (else ...)
+            j = 0
+            while j < len(rest) and not (isinstance(rest[j], list) and rest[j][:1] == ['then']):
+                j += 1
+            if j == len(rest):
+                raise ValueError('Folded if in WAT needs (then ...).')
+            self.parse_instructions(rest[:j])
+            self.instructions.append(Instruction('if', block_type))
+            self.labels.append(label)
+            self.parse_instructions(rest[j][1:])
+            for k, clause in enumerate(rest[j + 1:]):
+                if k > 0:
+                    raise ValueError('Unexpected %s after else in folded if in WAT.' % _to_text(clause))
+                elif not isinstance(clause, list) or clause[:1] != ['else']:
+                    raise ValueError('Unexpected %s in folded if in WAT.' % _to_text(clause))
+                self.instructions.append(Instruction('else'))
+                self.parse_instructions(clause[1:])
+            self.labels.pop()
+            self.instructions.append(Instruction('end'))
+        else:
+            # Plain instruction, with its operands folded in after the immediates
+            args, i = self.parse_immediates(type, item, 1)
+            self.parse_instructions(item[i:])
+            self.instructions.append(Instruction(type, *args))
+
+    def parse_immediates(self, type, items, i):
+        # Parse the immediates of a (non-block) instruction. Returns (args, index).
+        args = []
+        for kind in OPCODE_IMMEDIATES[type]:
+            if kind == 'memarg':
+                offset, align = 0, None
+                while i < len(items) and isinstance(items[i], str) and items[i].startswith(('offset=', 'align=')):
+                    key, value = items[i].split('=')
+                    if key == 'offset':
+                        offset = _parse_int(value, 33)
+                    else:
+                        align = _parse_int(value, 33)
+                    i += 1
+                if align is None:
+                    flags = _get_natural_alignment(type)
+                elif align & (align - 1) or align == 0:
+                    raise ValueError('Alignment must be a power of two in WAT: %i' % align)
+                else:
+                    flags = align.bit_length() - 1
+                args.extend([flags, offset])
+            elif kind == 'reserved':
+                pass
+            elif kind == 'br_table':
+                targets = []
+                while i < len(items) and isinstance(items[i], str):
+                    targets.append(self.get_label_depth(items[i]))
+                    i += 1
+                if not targets:
+                    raise ValueError('br_table in WAT needs at least one target.')
+                args.extend([targets[:-1], targets[-1]])
+            elif i >= len(items):
+                raise ValueError('Missing immediate for %s in WAT.' % WAT_NAMES[type])
+            elif type == 'call_indirect':
+                if not isinstance(items[i], list) or items[i][:1] != ['type']:
+                    raise ValueError('call_indirect in WAT needs (type ...).')
+                args.append(self.parser._get_index(items[i][1], self.parser.type_names, 'type'))
+                i += 1
+            else:
+                args.append(self.parse_immediate(type, kind, items[i]))
+                i += 1
+        return args, i
+
+    def parse_immediate(self, type, kind, item):
+        if not isinstance(item, str):
+            raise ValueError('Expected immediate for %s in WAT, got %s' %
+                             (WAT_NAMES[type], _to_text(item)))
+        if kind == 'varint32':
+            return _parse_int(item, 32)
+        elif kind == 'varint64':
+            return _parse_int(item, 64)
+        elif kind == 'f32':
+            return _parse_float(item, 32)
+        elif kind == 'f64':
+            return _parse_float(item, 64)
+        elif type in ('br', 'br_if'):
+            return self.get_label_depth(item)
+        elif type == 'call':
+            return self.parser._get_func_index(item)
+        elif type in ('get_local', 'set_local', 'tee_local'):
+            return self.parser._get_index(item, self.local_names, 'local')
+        else:
+            return _parse_int(item, 33)
+
+    def get_label_depth(self, item):
+        if _is_id(item):
+            for depth, label in enumerate(reversed(self.labels)):
+                if label == item:
+                    return depth
+            raise ValueError('Unknown label %s in WAT.' % item)
+        return _parse_int(item, 33)
+
+
+def _get_natural_alignment(type):
+    # Get the alignment flags (log2 of the alignment) of a memory access
+    op = type.split('.')[1]
+    bits = (op[4:] if op.startswith('load') else op[5:]).split('_')[0] or type[1:3]
+    return {8: 0, 16: 1, 32: 2, 64: 3}[int(bits)]
+
+
+def _to_text(item):
+    # Get an item (a token or nested list) as text, for error messages
+    if isinstance(item, list):
+        text = '(' + ' '.join(_to_text(i) for i in item) + ')'
+        return text if len(text) < 80 else text[:77] + '...'
+    return str(item)